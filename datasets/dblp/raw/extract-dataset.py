@@ -126,14 +126,15 @@ df.to_csv('nodes.int.csv', index=False, header=True, quoting=csv.QUOTE_NONNUMERI
 df = pd.DataFrame(enumerate(i2r), columns=['index', 'label'])
 df.to_csv('relations.int.csv', index=False, header=True, quoting=csv.QUOTE_NONNUMERIC)
 
-e2i = {e: i for i, e in enumerate(i2e)}
+e2i = kg.FrontCodedDict.from_pairs(i2e)
 r2i = {r: i for i, r in enumerate(i2r)}
 
 for file in ['training', 'testing', 'validation', 'meta-testing']:
     df = pd.read_csv(file + '.csv')
     classes = df.cls
     instances = df.instance
-    intinstances = instances.map(lambda ent : e2i[(ent, 'iri')])
+    intinstances = pd.Series(e2i.lookup([(ent, 'iri') for ent in instances]), index=instances.index, name=instances.name)
+    assert (intinstances >= 0).all(), f'Instances in {file}.csv not found among the nodes.'
     # -- all instances have datatype iri
 
     pd.concat([intinstances, classes], axis=1).to_csv(file + '.int.csv', index=False, header=True)
@@ -143,12 +144,23 @@ triples, c = doc.search_triples('', '', '')
 print('Writing integer triples.')
 with gzip.open('triples.int.csv.gz', 'wt') as file:
 
-    for s, p, o in tqdm(triples, total=c):
+    def write(batch):
+        # -- look up the subjects and objects of a batch of triples in one go
+        subjects = e2i.lookup([kg.entity_hdt(s) for s, _, _ in batch])
+        objects  = e2i.lookup([kg.entity_hdt(o) for _, _, o in batch])
+
+        assert (subjects >= 0).all() and (objects >= 0).all()
 
-        sp = kg.entity_hdt(s)
-        op = kg.entity_hdt(o)
+        file.write(''.join(f'{si}, {r2i[p]}, {oi}\n' for si, (_, p, _), oi in zip(subjects, batch, objects)))
+
+    batch = []
+    for s, p, o in tqdm(triples, total=c):
+        batch.append((s, p, o))
+        if len(batch) >= 100_000:
+            write(batch)
+            batch = []
 
-        file.write(f'{e2i[sp]}, {r2i[p]}, {e2i[op]}\n')
+    write(batch)
 
 
 
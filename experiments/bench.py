@@ -0,0 +1,506 @@
+"""
+Benchmarks for the performance-critical parts of the data loader and the baselines.
+
+Each benchmark is a separate command, for instance:
+
+python bench.py parse --n 5_000_000
+
+"""
+
+import fire, sys, os, gzip, tempfile
+
+import numpy as np
+
+import kgbench as kg
+from kgbench import tic, toc
+
+def fastload_lines(file):
+    """
+    The original, line-by-line implementation of `kg.fastload`, kept as a baseline.
+    """
+    with gzip.open(file, 'rt') as input:
+        lines = 0
+        for _ in input:
+            lines += 1
+
+    result = np.zeros((lines, 3), dtype=int)
+
+    with gzip.open(file, 'rt') as input:
+        for i, line in enumerate(input):
+            s, p, o = str(line).split(',')
+            s, p, o = int(s), int(p), int(o)
+            result[i, :] = (s, p, o)
+
+    return result
+
+def synthetic_triples(file, n, num_nodes=1_600_000, num_relations=133, seed=0):
+    """
+    Writes n random triples to a gzipped CSV file in the format written by the converters.
+    """
+    rng = np.random.default_rng(seed)
+
+    triples = np.stack([
+        rng.integers(num_nodes, size=n),
+        rng.integers(num_relations, size=n),
+        rng.integers(num_nodes, size=n)], axis=1)
+
+    with gzip.open(file, 'wt') as out:
+        for fr in range(0, n, 100_000):
+            out.write(''.join(f'{s}, {p}, {o}\n' for s, p, o in triples[fr:fr+100_000].tolist()))
+
+    return triples
+
+def synthetic(num_nodes=100_000, num_triples=500_000, num_relations=50, num_labeled=2_000, seed=0, torch=False,
+              window=None, zipf=None):
+    """
+    Creates a random Data object, for benchmarks that should run without a downloaded dataset. A handful of datatypes
+    are assigned at random.
+
+    :param window: If given, the graph has locality that is hidden by the node indices: the object of each triple is
+        within `window` positions of its subject in some random order of the nodes.
+    :param zipf: If given, the frequency of the relations falls off with this exponent, and the labels are not random:
+        each labeled node gets one extra outgoing triple, and its class is determined by the relation of that triple.
+    """
+    rng = np.random.default_rng(seed)
+
+    datatypes = ['iri', 'blank_node', 'none', '@en', 'http://www.w3.org/2001/XMLSchema#integer',
+                 'http://kgbench.info/dt#base64Image']
+    codes = rng.integers(len(datatypes), size=num_nodes)
+
+    data = kg.Data(None)
+    data.num_entities, data.num_relations, data.num_classes = num_nodes, num_relations, 3
+
+    data.i2e = kg.NodeTable.from_columns([str(i) for i in range(num_nodes)], [datatypes[c] for c in codes], datatypes)
+    data.e2i = kg.FrontCodedDict.from_table(data.i2e)
+    data.i2r = [f'r{i}' for i in range(num_relations)]
+    data.r2i = {r: i for i, r in enumerate(data.i2r)}
+
+    if zipf is None:
+        relations = lambda size : rng.integers(num_relations, size=size)
+    else:
+        p = 1.0 / np.arange(1, num_relations + 1) ** zipf
+        relations = lambda size : rng.choice(num_relations, size=size, p=p / p.sum())
+
+    data.triples = np.stack([
+        rng.integers(num_nodes, size=num_triples),
+        relations(num_triples),
+        rng.integers(num_nodes, size=num_triples)], axis=1)
+
+    if window is not None:
+        hidden = rng.permutation(num_nodes)
+        offsets = rng.integers(-window, window + 1, size=num_triples)
+        data.triples[:, 2] = hidden[np.clip(np.argsort(hidden)[data.triples[:, 0]] + offsets, 0, num_nodes - 1)]
+
+    labeled = rng.choice(num_nodes, size=num_labeled, replace=False)
+    classes = rng.integers(data.num_classes, size=num_labeled)
+
+    if zipf is not None:
+        extra = np.stack([labeled, relations(num_labeled), rng.integers(num_nodes, size=num_labeled)], axis=1)
+        data.triples = np.concatenate([data.triples, extra], axis=0)
+        classes = extra[:, 1] % data.num_classes
+    data.training = np.stack([labeled[:num_labeled//2], classes[:num_labeled//2]], axis=1)
+    data.withheld = np.stack([labeled[num_labeled//2:], classes[num_labeled//2:]], axis=1)
+
+    data.final, data.torch = False, torch
+    if torch:
+        import torch as T
+        data.triples, data.training, data.withheld = \
+            T.from_numpy(data.triples), T.from_numpy(data.training), T.from_numpy(data.withheld)
+
+    return data
+
+def dataset(name, final=False, torch=False, prune=None, nodes=100_000, zipf=None):
+    """
+    Loads a dataset by name, or creates a synthetic one if name is 'synthetic'.
+    """
+    if name == 'synthetic':
+        data = synthetic(num_nodes=nodes, num_triples=5 * nodes, torch=torch, zipf=zipf)
+        return data if prune is None else kg.prune(data, n=prune)
+
+    return kg.load(name, final=final, torch=torch, prune_dist=prune)
+
+def parse(n=2_000_000, blocksize=2**24, baseline=True):
+    """
+    Triple parsing throughput of `kg.fastload` against the original line-by-line parser, on a synthetic file.
+    """
+
+    with tempfile.TemporaryDirectory() as dir:
+        file = os.path.join(dir, 'triples.int.csv.gz')
+        triples = synthetic_triples(file, n)
+
+        tic()
+        result = kg.fastload(file, blocksize=blocksize)
+        t = toc()
+        assert (result == triples).all()
+        print(f'block parser: {n/t:,.0f} triples/s ({t:.4}s)')
+
+        if baseline:
+            tic()
+            result = fastload_lines(file)
+            tb = toc()
+            assert (result == triples).all()
+            print(f'line parser:  {n/tb:,.0f} triples/s ({tb:.4}s)')
+            print(f'speedup {tb/t:.3}x')
+
+def group_loop(data):
+    """
+    The original implementation of `kg.group`, with a Python loop over the triples, kept as a baseline. Returns only the
+    regrouped triples.
+    """
+    n2o = []
+    for datatype in data.datatypes():
+        n2o.extend(data.datatype_l2g(datatype))
+
+    o2n = {o: n for n, o in enumerate(n2o)}
+
+    triples = np.zeros(data.triples.shape, dtype=int)
+    for row, (s, p, o) in enumerate(data.triples):
+        triples[row, :] = (o2n[s], p, o2n[o])
+
+    return triples
+
+def group(name='dblp', baseline=True):
+    """
+    Time taken by `kg.group` against the original implementation.
+    """
+    data = dataset(name)
+    print(f'{name}: {data.num_entities} nodes, {data.triples.shape[0]} triples')
+
+    tic()
+    grouped = kg.group(data)
+    t = toc()
+    print(f'vectorized group: {t:.4}s')
+
+    if baseline:
+        tic()
+        triples = group_loop(data)
+        tb = toc()
+        print(f'loop group:       {tb:.4}s')
+        print(f'speedup {tb/t:.3}x')
+
+        assert (triples == grouped.triples).all()
+
+def synthetic_images(n=2_000, size=(400, 300), seed=0):
+    """
+    Returns a lazy view over n random JPEG images, stored as base64 literals like those in the datasets.
+    """
+    import base64, io
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    dt = 'http://kgbench.info/dt#base64Image'
+
+    labels = []
+    for _ in range(n):
+        # -- smooth noise, so the images compress like photos rather than like static
+        small = rng.integers(256, size=(size[1]//16, size[0]//16, 3), dtype=np.uint8)
+        img = Image.fromarray(small).resize(size, Image.BILINEAR)
+
+        out = io.BytesIO()
+        img.save(out, format='JPEG')
+        labels.append(base64.urlsafe_b64encode(out.getvalue()).decode('ascii'))
+
+    table = kg.NodeTable.from_columns(labels, [dt] * n, [dt])
+    return kg.Images(table, np.arange(n), cache=0)
+
+def tvbatches(name='synthetic', n=2_000, batch_size=256, max_workers=None, prefetch=2):
+    """
+    Throughput in images/s of `kg.to_tvbatches` with the mobilenet preprocessing used in mrgcn.py, for an increasing
+    number of workers. The image cache is disabled, so every image is decoded.
+    """
+    from torchvision import transforms
+    import torch
+
+    prep = transforms.Compose([
+        transforms.Resize(256),
+        transforms.CenterCrop(224),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+    ])
+
+    if name == 'synthetic':
+        images = synthetic_images(n)
+    else:
+        images = kg.load(name).get_images(cache=0)[:n]
+
+    max_workers = os.cpu_count() if max_workers is None else max_workers
+    print(f'{name}: {len(images)} images, batch size {batch_size}')
+
+    base = None
+    for workers in range(0, max_workers + 1):
+        tic()
+        for batch in kg.to_tvbatches(images, batch_size=batch_size, prep=prep, min_size=224, dtype=torch.float32,
+                                     workers=workers, prefetch=prefetch):
+            pass
+        t = toc()
+
+        base = t if base is None else base
+        print(f'{workers:3} workers: {len(images)/t:,.0f} images/s ({t:.4}s, speedup {base/t:.3}x)')
+
+def synthetic_sizes(n=20_000, seed=0):
+    """
+    Random (width, height) pairs: mostly landscape photos at varying scales, with some portrait and square images.
+    """
+    rng = np.random.default_rng(seed)
+
+    scale = rng.lognormal(5.5, 0.5, size=n)
+    ratio = rng.choice([4/3, 3/4, 1, 16/9], size=n, p=[.5, .2, .2, .1])
+
+    return np.maximum(16, np.stack([scale * np.sqrt(ratio), scale / np.sqrt(ratio)], axis=1)).astype(int)
+
+def padding(names=('synthetic',), batch_size=256, min_size=224, window=4):
+    """
+    The padding added by batching images in dataset order and in the order of `kg.size_order`, per dataset. Reported as
+    the number of pixels in the batches relative to the number of pixels in the images.
+    """
+    names = [names] if type(names) == str else names
+
+    for name in names:
+        if name == 'synthetic':
+            sizes = synthetic_sizes()
+        else:
+            tic()
+            sizes = np.maximum(kg.load(name).get_image_info()[:, :2], 1) # -- unreadable images become 1x1
+            print(f'read {len(sizes)} image sizes ({toc():.4}s).')
+
+        base, total = kg.padding(sizes, batch_size=batch_size, min_size=min_size)
+
+        tic()
+        order = kg.size_order(sizes, batch_size=batch_size, window=window)
+        t = toc()
+        bucketed, _ = kg.padding(sizes, batch_size=batch_size, min_size=min_size, order=order)
+
+        print(f'{name}: {len(sizes)} images, batch size {batch_size}')
+        print(f'   dataset order: {base/total:.3}x the image pixels')
+        print(f'   size order:    {bucketed/total:.3}x the image pixels ({t:.3}s to sort)')
+        print(f'   {1 - bucketed/base:.1%} fewer pixels per epoch')
+
+def sampler(name='synthetic', fanouts=(10, 10), batch_size=256, workers=(0, 1, 2, 4), batches=200, final=False):
+    """
+    Throughput in batches per second of `kg.NeighborSampler`, used as the collate function of a DataLoader over the
+    training nodes, for different numbers of worker processes.
+    """
+    from torch.utils.data import DataLoader
+
+    data = dataset(name, final=final)
+    print(f'{name}: {data.num_entities} nodes, {data.triples.shape[0]} triples, {data.training.shape[0]} training nodes')
+
+    tic()
+    sampler = kg.NeighborSampler(data, fanouts=list(fanouts))
+    print(f'adjacency index: {toc():.4}s')
+
+    for w in [workers] if type(workers) == int else workers:
+        loader = DataLoader(data.training, batch_size=batch_size, shuffle=True, collate_fn=sampler, num_workers=w,
+                            persistent_workers=w > 0)
+
+        num, nodes, edges = 0, 0, 0
+        tic()
+        while num < batches: # -- as many epochs as needed
+            for sample in loader:
+                num += 1
+                nodes += sample.nodes.size(0)
+                edges += sum(block.edges.size(0) for block in sample.blocks)
+        t = toc()
+
+        print(f'{w:3} workers: {num/t:,.1f} batches/s ({t:.4}s, {nodes/num:,.0f} nodes and {edges/num:,.0f} edges per batch)')
+
+def train_rgcn(name, restrict, epochs, bases, emb, prune, nodes, queue, csr=False, threads=None, compact=None,
+               zipf=None):
+    """
+    Trains the RGCN baseline for a few epochs, and puts the mean time per epoch (after the first), the peak memory
+    use of the process in MB, the accuracy on the withheld data (in the last epoch) and the number of parameters on the
+    queue.
+
+    :param compact: If given, the relations are first compacted to this many (see `kg.compact`), with the rest merged.
+    """
+    import resource, torch
+    import torch.nn.functional as F
+    import rgcn
+
+    if threads is not None:
+        torch.set_num_threads(threads)
+    torch.manual_seed(0)
+
+    data = dataset(name, torch=True, prune=2 if prune else None, nodes=nodes, zipf=zipf)
+    if compact is not None:
+        data = kg.compact(data, k=compact)
+
+    model = rgcn.RGCN(data.triples, n=data.num_entities, r=data.num_relations, numcls=data.num_classes, emb=emb,
+                      bases=bases, csr=csr)
+    opt = torch.optim.Adam(lr=0.01, params=model.parameters())
+
+    idxt, clst = data.training[:, 0], data.training[:, 1]
+    idxw, clsw = data.withheld[:, 0], data.withheld[:, 1]
+
+    times = []
+    for e in range(epochs):
+        tic()
+        opt.zero_grad()
+
+        if restrict:
+            out = model(torch.cat([idxt, idxw]))
+            out_train, out_withheld = out[:idxt.size(0)], out[idxt.size(0):]
+        else:
+            out = model()
+            out_train, out_withheld = out[idxt], out[idxw]
+
+        F.cross_entropy(out_train, clst).backward()
+        opt.step()
+        times.append(toc())
+
+    accuracy = (out_withheld.argmax(dim=1) == clsw).float().mean().item()
+    parameters = sum(p.numel() for p in model.parameters())
+
+    queue.put((sum(times[1:]) / max(1, len(times) - 1), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+               accuracy, parameters))
+
+def restrict(names=('synthetic',), epochs=5, bases=None, emb=16, prune=False, nodes=20_000):
+    """
+    Time per epoch and peak memory of the RGCN baseline with the full forward pass, and with the forward pass
+    restricted to the labeled nodes. Each run gets its own process, so that the peak memory use is separate.
+    """
+    import multiprocessing as mp
+
+    ctx = mp.get_context('spawn')
+    names = [names] if type(names) == str else names
+
+    for name in names:
+        results = {}
+        for mode in [False, True]:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=train_rgcn, args=(name, mode, epochs, bases, emb, prune, nodes, queue))
+            proc.start()
+            results[mode] = queue.get()
+            proc.join()
+
+        (tf, mf, _, _), (tr, mr, _, _) = results[False], results[True]
+        print(f'{name}: full {tf:.4}s/epoch, {mf:,.0f}MB peak; restricted {tr:.4}s/epoch, {mr:,.0f}MB peak '
+              f'({tf/tr:.3}x faster, {1 - mr/mf:.1%} less memory)')
+
+DATASETS = ('aifb', 'amplus', 'dblp', 'dmg777k', 'dmgfull', 'mdgender', 'mdgenre')
+
+def kernels(names=DATASETS + ('synthetic',), epochs=5, bases=None, emb=16, prune=False, nodes=100_000, threads=None):
+    """
+    Time per epoch of the RGCN baseline (full forward pass) with the default sparse products, and with the CSR kernel
+    of `kg.CSRAdjacency`. Each run gets its own process. Datasets that fail to load or train are reported and skipped.
+
+    :param threads: The number of threads for pytorch and for the CSR kernel. Defaults to pytorch's default.
+    """
+    import multiprocessing as mp
+
+    ctx = mp.get_context('spawn')
+    names = [names] if type(names) == str else names
+
+    for name in names:
+        results = {}
+        for csr in [False, True]:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=train_rgcn, args=(name, False, epochs, bases, emb, prune, nodes, queue, csr, threads))
+            proc.start()
+            proc.join()
+
+            results[csr] = None if queue.empty() else queue.get()
+
+        if None in results.values():
+            print(f'{name}: failed (exit code {proc.exitcode}), skipped.')
+            continue
+
+        (tc, mc, _, _), (tr, mr, _, _) = results[False], results[True]
+        print(f'{name}: default {tc:.4}s/epoch, {mc:,.0f}MB peak; csr {tr:.4}s/epoch, {mr:,.0f}MB peak ({tc/tr:.3}x faster)')
+
+def compact(names=('synthetic',), ks=(None, 20, 10, 5, 2), epochs=50, bases=None, emb=16, prune=False,
+            nodes=20_000, zipf=1.5):
+    """
+    Memory, time per epoch and withheld accuracy of the RGCN baseline when the relations are compacted to the k most
+    frequent ones (see `kg.compact`), for several values of k. Each run gets its own process. None means no compaction.
+
+    :param zipf: For the synthetic data, the exponent of the relation frequencies (see `synthetic()`).
+    """
+    import multiprocessing as mp
+
+    ctx = mp.get_context('spawn')
+    names = [names] if type(names) == str else names
+    ks = [ks] if type(ks) == int else ks
+
+    for name in names:
+        print(f'{name}:')
+        for k in ks:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=train_rgcn,
+                               args=(name, False, epochs, bases, emb, prune, nodes, queue, False, None, k, zipf))
+            proc.start()
+            proc.join()
+
+            if queue.empty():
+                print(f'    k={k}: failed (exit code {proc.exitcode}), skipped.')
+                continue
+
+            t, m, acc, params = queue.get()
+            print(f'    k={k}: {params:,} parameters, {m:,.0f}MB peak, {t:.4}s/epoch, withheld accuracy {acc:.3}')
+
+def reorder(name='synthetic', nodes=100_000, window=100, emb=16, fanouts=(10, 10), batch_size=256, batches=200,
+            repeats=5, threads=None):
+    """
+    Time of the sparse products of the RGCN's second layer (with the default kernel and with `kg.CSRAdjacency`) and
+    throughput of `kg.NeighborSampler`, before and after reordering the nodes with `kg.reorder`.
+
+    :param window: For the synthetic data, the hidden locality of the graph (see `synthetic()`). None for a random
+        graph.
+    """
+    import torch
+
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+    if name == 'synthetic':
+        original = synthetic(num_nodes=nodes, num_triples=5 * nodes, window=window)
+    else:
+        original = kg.load(name)
+
+    tic()
+    reordered = kg.reorder(original)
+    print(f'{name}: {original.num_entities} nodes, {original.triples.shape[0]} triples, reordered in {toc():.4}s')
+
+    for label, data in [('original', original), ('reordered', reordered)]:
+        n, r = data.num_entities, data.num_relations
+
+        adjacency = kg.Adjacency(torch.from_numpy(data.triples), n, r)
+        csr = kg.CSRAdjacency(adjacency, threads=threads)
+
+        h = torch.randn(n, emb)
+        weights = torch.randn(adjacency.num_stacked, emb, emb)
+
+        times = {}
+        for kernel, adj in [('default', adjacency), ('csr', csr)]:
+            adj.stacked(h, weights) # -- warm-up
+            tic()
+            for _ in range(repeats):
+                adj.stacked(h, weights)
+            times[kernel] = toc() / repeats
+
+        sampler = kg.NeighborSampler(data, fanouts=list(fanouts))
+        rng = np.random.default_rng(0)
+        targets = data.training[:, 0]
+
+        tic()
+        for _ in range(batches):
+            sampler.sample(rng.choice(targets, size=min(batch_size, targets.shape[0]), replace=False), rng=rng)
+        throughput = batches / toc()
+
+        print(f'{label:>9}: spmm {times["default"]:.4}s (default), {times["csr"]:.4}s (csr); '
+              f'sampler {throughput:,.1f} batches/s')
+
+if __name__ == '__main__':
+
+    print('arguments ', ' '.join(sys.argv))
+    fire.Fire({
+        'parse': parse,
+        'group': group,
+        'tvbatches': tvbatches,
+        'padding': padding,
+        'sampler': sampler,
+        'restrict': restrict,
+        'kernels': kernels,
+        'compact': compact,
+        'reorder': reorder
+    })
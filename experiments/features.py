@@ -82,31 +82,25 @@ def go(name='mdgenre', final=True, numfeatures=2_000, printweights=False):
     infull, outfull = {}, {}
 
     # Create some dictionaries for easy access
+    # -- only the labeled nodes are ever looked up, so we read their neighborhoods from the adjacency index
     print('Creating dicts.')
-    for s, p, o in tqdm.tqdm(data.triples):
-
-        if s not in rels:
-            rels[s] = set()
-        if o not in rels:
-            rels[o] = set()
-        rels[s].add(p)
-        rels[o].add(p)
-
-        if o not in inrels:
-            inrels[o] = set()
-        if s not in outrels:
-            outrels[s] = set()
-
-        outrels[s].add(p)
-        inrels[o].add(p)
-
-        if o not in infull:
-            infull[o] = set()
-        if s not in outfull:
-            outfull[s] = set()
-
-        infull[o].add((p, s))
-        outfull[s].add((p, o))
+    out, inc = data.csr('out'), data.csr('in')
+
+    for inst in tqdm.tqdm(np.concatenate([data.training[:, 0], data.withheld[:, 0]]).tolist()):
+
+        orels, onbrs = out.relations_of(inst).tolist(), out.neighbors_of(inst).tolist()
+        irels, inbrs = inc.relations_of(inst).tolist(), inc.neighbors_of(inst).tolist()
+
+        if len(orels) + len(irels) > 0:
+            rels[inst] = set(orels) | set(irels)
+
+        if len(irels) > 0:
+            inrels[inst] = set(irels)
+            infull[inst] = set(zip(irels, inbrs))
+
+        if len(orels) > 0:
+            outrels[inst] = set(orels)
+            outfull[inst] = set(zip(orels, onbrs))
 
     # Compute the features
     # - Tallies for all features
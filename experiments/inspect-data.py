@@ -2,7 +2,7 @@ import fire, sys, tqdm
 
 import kgbench as kg
 
-from collections import Counter
+import numpy as np
 
 """
 Load a dataset and print statistics.
@@ -23,11 +23,11 @@ def go(name='amplus'):
 
     literals = 0
     for datatype in data.datatypes():
-        print(f'    {datatype}, {len(data.get_strings(datatype))} ')
+        print(f'    {datatype}, {len(data.datatype_l2g(datatype))} ')
         if datatype not in ['iri', 'blank_node']:
-            literals += len(data.get_strings(datatype))
+            literals += len(data.datatype_l2g(datatype))
 
-    print(f'{len(data.get_strings("iri")) + len(data.get_strings("blank_node"))} entities.')
+    print(f'{len(data.datatype_l2g("iri")) + len(data.datatype_l2g("blank_node"))} entities.')
     print(f'{literals} literals.')
     print()
     print(f'{data.num_classes} classes ')
@@ -39,19 +39,16 @@ def go(name='amplus'):
     print()
 
     print('Nr of edges between two nodes:')
-    ctr = Counter()
 
     # count edge frequencies
-    for s, _, o in data.triples:
-        ctr[(s,o)] += 1
+    pairs = data.triples[:, 0].astype(np.int64) * data.num_entities + data.triples[:, 2]
+    _, ctr = np.unique(pairs, return_counts=True)
 
     # count frequency frequencies
-    fctr = Counter()
-    for pair, freq in ctr.items():
-        fctr[freq] += 1
+    freqs, fctr = np.unique(ctr, return_counts=True)
 
-    for freq in sorted(list(fctr.keys())):
-        print(freq, fctr[freq])
+    for freq, num in zip(freqs.tolist(), fctr.tolist()):
+        print(freq, num)
 
     print()
 
@@ -23,97 +23,23 @@ from torchvision import transforms
 
 from sklearn.decomposition import PCA
 
-def enrich(triples : torch.Tensor, n : int, r: int):
-
-    cuda = triples.is_cuda
-
-    inverses = torch.cat([
-        triples[:, 2:],
-        triples[:, 1:2] + r,
-        triples[:, :1]
-    ], dim=1)
-
-    selfloops = torch.cat([
-        torch.arange(n, dtype=torch.long,  device=d(cuda))[:, None],
-        torch.full((n, 1), fill_value=2*r),
-        torch.arange(n, dtype=torch.long, device=d(cuda))[:, None],
-    ], dim=1)
-
-    return torch.cat([triples, inverses, selfloops], dim=0)
-
-def sum_sparse(indices, values, size, row=True):
-    """
-    Sum the rows or columns of a sparse matrix, and redistribute the
-    results back to the non-sparse row/column entries
-
-    :return:
-    """
-
-    ST = torch.cuda.sparse.FloatTensor if indices.is_cuda else torch.sparse.FloatTensor
-
-    assert len(indices.size()) == 2
-
-    k, r = indices.size()
-
-    if not row:
-        # transpose the matrix
-        indices = torch.cat([indices[:, 1:2], indices[:, 0:1]], dim=1)
-        size = size[1], size[0]
-
-    ones = torch.ones((size[1], 1), device=d(indices))
-
-    smatrix = ST(indices.t(), values, size=size)
-    sums = torch.mm(smatrix, ones) # row/column sums
-
-    sums = sums[indices[:, 0]]
-
-    assert sums.size() == (k, 1)
-
-    return sums.view(k)
-
-def adj(triples, num_nodes, num_rels, cuda=False, vertical=True):
-    """
-     Computes a sparse adjacency matrix for the given graph (the adjacency matrices of all
-     relations are stacked vertically).
-
-     :param edges: List representing the triples
-     :param i2r: list of relations
-     :param i2n: list of nodes
-     :return: sparse tensor
-    """
-    r, n = num_rels, num_nodes
-    size = (r * n, n) if vertical else (n, r * n)
-
-    from_indices = []
-    upto_indices = []
-
-    for fr, rel, to in triples:
-
-        offset = rel.item() * n
-
-        if vertical:
-            fr = offset + fr.item()
-        else:
-            to = offset + to.item()
-
-        from_indices.append(fr)
-        upto_indices.append(to)
-
-    indices = torch.tensor([from_indices, upto_indices], dtype=torch.long, device=d(cuda))
-
-    assert indices.size(1) == len(triples)
-    assert indices[0, :].max() < size[0], f'{indices[0, :].max()}, {size}, {r}'
-    assert indices[1, :].max() < size[1], f'{indices[1, :].max()}, {size}, {r}'
-
-    return indices.t(), size
-
 class RGCN(nn.Module):
     """
     We use a classic RGCN, with embeddings as inputs (instead of the one-hot inputs of rgcn.py)
 
     """
 
-    def __init__(self, triples, n, r, insize, hidden, numcls, bases=None):
+    def __init__(self, triples, n, r, insize, hidden, numcls, bases=None, adjacency=None, chunk=None, checkpoint=False,
+                 csr=False):
+        """
+        :param adjacency: The `kg.Adjacency` of the triples, if it has already been computed.
+        :param chunk: Compute each layer for this many relations at a time, instead of for all relations at once. This
+            reduces the size of the intermediate values from relations x nodes x emb to chunk x nodes x emb.
+        :param checkpoint: With `chunk`, recompute the intermediate values of each chunk in the backward pass, instead
+            of keeping them in memory.
+        :param csr: Compute both layers with `kg.CSRAdjacency`, which is faster on the CPU, but stores the matrices
+            explicitly. With this kernel, `chunk` has no effect.
+        """
 
         super().__init__()
 
@@ -121,24 +47,20 @@ class RGCN(nn.Module):
         self.hidden = hidden
         self.bases = bases
         self.numcls = numcls
+        self.chunk, self.checkpoint = chunk, checkpoint
+        self.csr, self.operator = csr, None
 
-        self.triples = enrich(triples, n, r)
-
-        # horizontally and vertically stacked versions of the adjacency graph
-        hor_ind, hor_size = adj(self.triples, n, 2*r+1, vertical=False)
-        ver_ind, ver_size = adj(self.triples, n, 2*r+1, vertical=True)
-
-        _, rn = hor_size
-        r = rn // n
+        if adjacency is None:
+            adjacency = kg.Adjacency(triples, n, r)
 
-        vals = torch.ones(ver_ind.size(0), dtype=torch.float)
-        vals = vals / sum_sparse(ver_ind, vals, ver_size)
+        # -- the adjacency matrices, with inverse edges and self-loops computed on the fly from the triples
+        self.register_buffer('triples', adjacency.triples, persistent=False)
+        self.register_buffer('out_norm', adjacency.out_norm, persistent=False)
+        self.register_buffer('in_norm', adjacency.in_norm, persistent=False)
 
-        hor_graph = torch.sparse.FloatTensor(indices=hor_ind.t(), values=vals, size=hor_size)
-        self.register_buffer('hor_graph', hor_graph)
+        self.n, self.r = n, r
 
-        ver_graph = torch.sparse.FloatTensor(indices=ver_ind.t(), values=vals, size=ver_size)
-        self.register_buffer('ver_graph', ver_graph)
+        r = 2*r+1 # -- relations, inverse relations and self-loops
 
         # layer 1 weights
         if bases is None:
@@ -173,17 +95,13 @@ class RGCN(nn.Module):
     def forward(self, features):
 
         # size of node representation per layer: f -> e -> c
-        n, rn = self.hor_graph.size()
-        r = rn // n
+        r = 2 * self.r + 1
         e = self.hidden
         b, c = self.bases, self.numcls
 
         n, f = features.size()
 
         ## Layer 1
-        h = torch.mm(self.ver_graph, features) # sparse mm
-        h = h.view(r, n, f) # new dim for the relations
-
         if self.bases1 is not None:
             weights = torch.einsum('rb, bij -> rij', self.comps1, self.bases1)
             # weights = torch.mm(self.comps1, self.bases1.view(b, n*e)).view(r, n, e)
@@ -192,28 +110,31 @@ class RGCN(nn.Module):
 
         assert weights.size() == (r, f, e)
 
-        # Apply weights and sum over relations
-        h = torch.bmm(h, weights).sum(dim=0)
+        adjacency = kg.Adjacency(self.triples, self.n, self.r, norms=(self.out_norm, self.in_norm))
+
+        if self.csr:
+            if self.operator is None: # -- built on first use
+                assert self.triples.device.type == 'cpu', 'The CSR kernel only runs on the CPU.'
+                self.operator = kg.CSRAdjacency(adjacency)
+
+            adjacency = self.operator
+
+        # Multiply adjacencies by features, apply weights and sum over relations
+        h = adjacency.stacked(features, weights, chunk=self.chunk, checkpoint=self.checkpoint)
 
         assert h.size() == (n, e)
 
         h = F.relu(h + self.bias1)
 
         ## Layer 2
-
-        # Multiply adjacencies by hidden
-        h = torch.mm(self.ver_graph, h) # sparse mm
-        h = h.view(r, n, e) # new dim for the relations
-
         if self.bases2 is not None:
             weights = torch.einsum('rb, bij -> rij', self.comps2, self.bases2)
             # weights = torch.mm(self.comps2, self.bases2.view(b, e * c)).view(r, e, c)
         else:
             weights = self.weights2
 
-        # Apply weights, sum over relations
-        # h = torch.einsum('rhc, rnh -> nc', weights, h)
-        h = torch.bmm(h, weights).sum(dim=0)
+        # Multiply adjacencies by hidden, apply weights, sum over relations
+        h = adjacency.stacked(h, weights, chunk=self.chunk, checkpoint=self.checkpoint)
 
         assert h.size() == (n, c)
 
@@ -228,7 +149,13 @@ class RGCN(nn.Module):
 
         return self.comps1.pow(p).sum() + self.bases1.pow(p).sum()
 
-def mobilenet_emb(pilimages, bs=512):
+def mobilenet_emb(images, bs=512, workers=4, bucket=True):
+    """
+    :param images: Either a uint8 tensor of shape (n, 3, 224, 224), as returned by `data.get_image_tensor()`, or a
+        sequence of PIL images.
+    :param bucket: For PIL images, batch images of similar size together to reduce the padding, and put the embeddings
+        back in the original order afterwards.
+    """
 
     # Create embeddings for image
     prep = transforms.Compose([
@@ -246,8 +173,20 @@ def mobilenet_emb(pilimages, bs=512):
     if torch.cuda.is_available():
         model.cuda()
 
-    nimages = len(pilimages)
-    imagegen = kg.to_tvbatches(pilimages, batch_size=bs, prep=prep, min_size=224, dtype=torch.float32)
+    nimages = len(images)
+
+    if torch.is_tensor(images):
+        # -- the images are already resized and cropped: slice batches (without copying) and normalize on the fly
+        mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+        std  = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+
+        imagegen = ((images[fr:fr+bs].to(torch.float32).div_(255.0) - mean).div_(std) for fr in range(0, nimages, bs))
+    else:
+        order = kg.size_order(images, batch_size=bs) if bucket else None
+
+        imagegen = kg.to_tvbatches(images, batch_size=bs, prep=prep, min_size=224, dtype=torch.float32, workers=workers,
+                                   order=order)
+        # -- the next batches are decoded while the model processes the current one
 
     for batch in tqdm.tqdm(imagegen, total=nimages // bs):
         bn, c, h, w = batch.size()
@@ -258,7 +197,15 @@ def mobilenet_emb(pilimages, bs=512):
         image_embeddings.append(out.view(bn, -1).to('cpu'))
         # print(image_embeddings[-1].size())
 
-    return torch.cat(image_embeddings, dim=0)
+    image_embeddings = torch.cat(image_embeddings, dim=0)
+
+    if not torch.is_tensor(images) and order is not None:
+        # -- reverse the sort by size
+        result = torch.empty_like(image_embeddings)
+        result[torch.from_numpy(order)] = image_embeddings
+        return result
+
+    return image_embeddings
 
 def bert_emb(strings, bs_chars, mname='distilbert-base-cased'):
     # Sort by length and reverse the sort after computing embeddings
@@ -336,31 +283,25 @@ def pca(tensor, target_dim):
 
     return res
 
-def go(name='amplus', lr=0.01, wd=0.0, l2=5e-4, epochs=50, prune=True, optimizer='adam', final=False, emb=16, bases=40, printnorms=None, imagebatch=256, stringbatch=50_000):
-
-    # bert_emb(['.....', '.', '..', '...', '....'], bs_chars = 50_000)
-
-    data = load(name, torch=True, prune_dist=2 if prune else None, final=final)
-    data = kg.group(data)
-
-    print(f'{data.triples.size(0)} triples')
-    print(f'{data.num_entities} entities')
-    print(f'{data.num_relations} relations')
-
-    if torch.cuda.is_available():
-        bmodel.cuda()
+def embed(data, emb, imagebatch=256, stringbatch=50_000, imageworkers=4, imagecache=True):
+    """
+    Computes an initial embedding of each node: random for the iris and blank nodes, and from a pre-trained encoder,
+    reduced to `emb` dimensions by PCA, for the literals.
 
+    :param data: A grouped dataset.
+    :return: An (n, emb) float tensor.
+    """
     tic()
     with torch.no_grad():
 
         embeddings = []
-        for datatype in data.datatypes():
+        # -- one block of nodes per annotation: language-tagged strings are only embedded in their own block
+        for datatype, fr, to in data.datatype_blocks():
             if datatype in ['iri', 'blank_node']:
                 print(f'Initializing embedding for datatype {datatype}.')
                 # create random embeddings
                 # -- we will parametrize this part of the input later
-                n = len(data.get_strings(dtype=datatype))
-                nodes = torch.randn(n, emb)
+                nodes = torch.randn(to - fr, emb)
                 if torch.cuda.is_available():
                     nodes = nodes.cuda()
 
@@ -368,22 +309,50 @@ def go(name='amplus', lr=0.01, wd=0.0, l2=5e-4, epochs=50, prune=True, optimizer
 
             elif datatype == 'http://kgbench.info/dt#base64Image':
                 print(f'Computing embeddings for images.')
-                image_embeddings = mobilenet_emb(data.get_images(), bs=imagebatch)
+                if imagecache: # preprocess once, and memory-map the result on subsequent runs
+                    images = data.get_image_tensor(size=224, resize=256, crop='center', workers=imageworkers)
+                else:
+                    images = data.get_images()
+
+                image_embeddings = mobilenet_emb(images, bs=imagebatch, workers=imageworkers)
                 image_embeddings = pca(image_embeddings, target_dim=emb)
                 embeddings.append(image_embeddings)
 
             else:
                 # embed literal strings with DistilBERT
                 print(f'Computing embeddings for datatype {datatype}.')
-                string_embeddings = bert_emb(data.get_strings(dtype=datatype), bs_chars=stringbatch)
+                string_embeddings = bert_emb(data.i2e.labels(range(fr, to)), bs_chars=stringbatch)
                 string_embeddings = pca(string_embeddings, target_dim=emb)
                 embeddings.append(string_embeddings)
 
         embeddings = torch.cat(embeddings, dim=0).to(torch.float)
         # -- note that we use the fact here that the data loader clusters the nodes by data type, in the
         #    order given by data._datasets
+        assert embeddings.size(0) == data.num_entities, f'{embeddings.size(0)} embeddings for {data.num_entities} nodes.'
     print(f'embeddings created in {toc()} seconds.')
 
+    return embeddings
+
+def go(name='amplus', lr=0.01, wd=0.0, l2=5e-4, epochs=50, prune=True, optimizer='adam', final=False, emb=16, bases=40, printnorms=None, imagebatch=256, stringbatch=50_000, imageworkers=4, imagecache=True, chunk=None, checkpoint=False, csr=False, compact=None, min_count=None, merge=True):
+
+    # bert_emb(['.....', '.', '..', '...', '....'], bs_chars = 50_000)
+
+    data = load(name, torch=True, prune_dist=2 if prune else None, final=final)
+
+    if compact is not None or min_count is not None:
+        data = kg.compact(data, k=compact, min_count=min_count, merge=merge)
+        print(f'compacted to {data.num_relations} relations')
+    data = kg.group(data)
+
+    print(f'{data.triples.size(0)} triples')
+    print(f'{data.num_entities} entities')
+    print(f'{data.num_relations} relations')
+
+    if torch.cuda.is_available():
+        bmodel.cuda()
+
+    embeddings = embed(data, emb, imagebatch, stringbatch, imageworkers, imagecache)
+
     # Split embeddings into trainable and non-trainable
     num_uri, num_bnode = len(data.datatype_l2g('uri')), len(data.datatype_l2g('blank_node'))
     numparms = num_uri + num_bnode
@@ -393,7 +362,13 @@ def go(name='amplus', lr=0.01, wd=0.0, l2=5e-4, epochs=50, prune=True, optimizer
     trainable = nn.Parameter(trainable)
 
     tic()
-    rgcn = RGCN(data.triples, n=data.num_entities, r=data.num_relations, insize=emb, hidden=emb, numcls=data.num_classes, bases=bases)
+    adjacency = kg.Adjacency(data.triples, data.num_entities, data.num_relations)
+    print(f'adjacency: {toc():.5}s')
+
+    tic()
+    rgcn = RGCN(data.triples, n=data.num_entities, r=data.num_relations, insize=emb, hidden=emb, numcls=data.num_classes,
+                bases=bases, adjacency=adjacency, chunk=chunk, checkpoint=checkpoint,
+                csr=csr and not torch.cuda.is_available())
 
     if torch.cuda.is_available():
         print('Using cuda.')
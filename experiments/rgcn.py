@@ -5,11 +5,14 @@ Run the RGCN baseline of the given dataset
 import fire, sys
 
 import torch
+import torch.utils.checkpoint
 from torch import nn
 import torch.nn.functional as F
 from kgbench import load, tic, toc, d
+import kgbench as kg
 
 from collections import Counter
+from functools import partial
 
 def enrich(triples : torch.Tensor, n : int, r: int):
 
@@ -37,27 +40,19 @@ def sum_sparse(indices, values, size, row=True):
     :return:
     """
 
-    ST = torch.cuda.sparse.FloatTensor if indices.is_cuda else torch.sparse.FloatTensor
-
     assert len(indices.size()) == 2
 
     k, r = indices.size()
 
-    if not row:
-        # transpose the matrix
-        indices = torch.cat([indices[:, 1:2], indices[:, 0:1]], dim=1)
-        size = size[1], size[0]
-
-    ones = torch.ones((size[1], 1), device=d(indices))
-
-    smatrix = ST(indices.t(), values, size=size)
-    sums = torch.mm(smatrix, ones) # row/column sums
+    # -- for column sums, count over the column indices instead
+    rows = indices[:, 0] if row else indices[:, 1]
 
-    sums = sums[indices[:, 0]]
+    sums = torch.bincount(rows, weights=values, minlength=size[0] if row else size[1])
+    sums = sums[rows]
 
-    assert sums.size() == (k, 1)
+    assert sums.size() == (k,)
 
-    return sums.view(k)
+    return sums.to(values.dtype)
 
 def adj(triples, num_nodes, num_rels, cuda=False, vertical=True):
     """
@@ -72,64 +67,116 @@ def adj(triples, num_nodes, num_rels, cuda=False, vertical=True):
     r, n = num_rels, num_nodes
     size = (r * n, n) if vertical else (n, r * n)
 
-    from_indices = []
-    upto_indices = []
+    fr, rel, to = triples[:, 0], triples[:, 1], triples[:, 2]
 
-    for fr, rel, to in triples:
+    offset = rel * n
 
-        offset = rel.item() * n
+    if vertical:
+        fr = offset + fr
+    else:
+        to = offset + to
 
-        if vertical:
-            fr = offset + fr.item()
-        else:
-            to = offset + to.item()
+    indices = torch.stack([fr, to], dim=1).to(dtype=torch.long, device=d(cuda))
+
+    assert indices.size(0) == len(triples)
+    if indices.size(0) > 0:
+        assert indices[:, 0].max() < size[0], f'{indices[:, 0].max()}, {size}, {r}'
+        assert indices[:, 1].max() < size[1], f'{indices[:, 1].max()}, {size}, {r}'
+
+    return indices, size
+
+def adjacencies(triples, n, r):
+    """
+    Computes the horizontally and vertically stacked adjacency matrices of the graph, after adding inverse edges and
+    self-loops. The values are normalized so that the rows of the vertically stacked matrix sum to one.
 
-        from_indices.append(fr)
-        upto_indices.append(to)
+    This is the explicit version of `kg.Adjacency`, which the model uses instead.
 
-    indices = torch.tensor([from_indices, upto_indices], dtype=torch.long, device=d(cuda))
+    :return: A dict with the indices of the horizontally stacked matrix (`hor`), those of the vertically stacked
+        matrix (`ver`), both (k, 2) tensors, and the values (`vals`).
+    """
+
+    triples = enrich(triples, n, r)
+
+    hor_ind, hor_size = adj(triples, n, 2*r+1, vertical=False)
+    ver_ind, ver_size = adj(triples, n, 2*r+1, vertical=True)
 
-    assert indices.size(1) == len(triples)
-    assert indices[0, :].max() < size[0], f'{indices[0, :].max()}, {size}, {r}'
-    assert indices[1, :].max() < size[1], f'{indices[1, :].max()}, {size}, {r}'
+    vals = torch.ones(ver_ind.size(0), dtype=torch.float)
+    vals = vals / sum_sparse(ver_ind, vals, ver_size)
 
-    return indices.t(), size
+    return {'hor': hor_ind, 'ver': ver_ind, 'vals': vals}
+
+def aggregate(rows, nodes, coefs, weights, num_rows):
+    """
+    :return: The sum, for each row, of the weight rows of the given nodes, scaled by the given coefficients.
+    """
+    return torch.zeros(num_rows, weights.size(1), device=weights.device).index_add(0, rows, weights[nodes] * coefs[:, None])
+
+def entries(graph):
+    """
+    :param graph: A sparse tensor.
+    :return: A function returning its nonzero entries as a single (rows, cols, vals) part, like `kg.Adjacency.parts`.
+    """
+    (rows, cols), vals = graph._indices(), graph._values()
+    return lambda : [(rows, cols, vals)]
 
 class RGCN(nn.Module):
     """
     Classic RGCN
+
+    The first layer is featureless: node j sends relation r the message W[r, j], so that the weights of the first layer
+    form an (r, n, emb) tensor. This tensor is never built. Without bases, only the rows W[r, j] for which node j has an
+    incoming edge with relation r are stored. With bases, the messages are computed one basis at a time.
     """
 
-    def __init__(self, triples, n, r, numcls, emb=16, bases=None):
+    def __init__(self, triples, n, r, numcls, emb=16, bases=None, adjacency=None, sparse=False, chunk=None,
+                 checkpoint=False, csr=False):
+        """
+        :param adjacency: The `kg.Adjacency` of the triples, if it has already been computed.
+        :param sparse: Compute the first layer by gathering weight rows, giving the weights of the first layer a sparse
+            gradient (only without bases). These should be trained with an optimizer for sparse gradients, like
+            `torch.optim.SparseAdam`. This way, only the rows used in a (restricted) forward pass are updated.
+        :param chunk: Compute the second layer for this many relations at a time, instead of for all relations at once.
+            This reduces the size of the intermediate values from relations x nodes x emb to chunk x nodes x emb.
+        :param checkpoint: With `chunk`, recompute the intermediate values of each chunk in the backward pass, instead
+            of keeping them in memory.
+        :param csr: Compute the second layer of the full forward pass with `kg.CSRAdjacency`, which is faster on the
+            CPU, but stores the matrices explicitly. With this kernel, `chunk` has no effect.
+        """
 
         super().__init__()
 
         self.emb = emb
         self.bases = bases
         self.numcls = numcls
+        self.sparse = sparse
+        self.chunk, self.checkpoint = chunk, checkpoint
+        self.csr, self.operator = csr, None
 
-        self.triples = enrich(triples, n, r)
-
-        # horizontally and vertically stacked versions of the adjacency graph
-        hor_ind, hor_size = adj(self.triples, n, 2*r+1, vertical=False)
-        ver_ind, ver_size = adj(self.triples, n, 2*r+1, vertical=True)
-
-        _, rn = hor_size
-        r = rn // n
+        if adjacency is None:
+            adjacency = kg.Adjacency(triples, n, r)
 
-        vals = torch.ones(ver_ind.size(0), dtype=torch.float)
-        vals = vals / sum_sparse(ver_ind, vals, ver_size)
+        # -- the adjacency matrices, with inverse edges and self-loops computed on the fly from the triples
+        self.register_buffer('triples', adjacency.triples, persistent=False)
+        self.register_buffer('out_norm', adjacency.out_norm, persistent=False)
+        self.register_buffer('in_norm', adjacency.in_norm, persistent=False)
 
-        hor_graph = torch.sparse.FloatTensor(indices=hor_ind.t(), values=vals, size=hor_size)
-        self.register_buffer('hor_graph', hor_graph)
+        r = 2*r+1 # -- relations, inverse relations and self-loops
+        self.n, self.r = n, r
 
-        ver_graph = torch.sparse.FloatTensor(indices=ver_ind.t(), values=vals, size=ver_size)
-        self.register_buffer('ver_graph', ver_graph)
+        if bases is None:
+            # -- only keep weight rows for the (relation, node) pairs that have edges: the columns of the horizontally
+            #    stacked adjacency
+            used = torch.unique(torch.cat([cols for _, cols, _ in adjacency.parts(horizontal=True)]))
+            self.register_buffer('used1', used)
 
         # layer 1 weights
         if bases is None:
-            self.weights1 = nn.Parameter(torch.FloatTensor(r, n, emb))
-            nn.init.xavier_uniform_(self.weights1, gain=nn.init.calculate_gain('relu'))
+            self.weights1 = nn.Parameter(torch.FloatTensor(used.size(0), emb))
+
+            # -- the same initialization as xavier_uniform_ on the full (r, n, emb) tensor
+            bound = nn.init.calculate_gain('relu') * (6.0 / (n * emb + r * emb)) ** 0.5
+            nn.init.uniform_(self.weights1, -bound, bound)
 
             self.bases1 = None
         else:
@@ -156,68 +203,210 @@ class RGCN(nn.Module):
         self.bias1 = nn.Parameter(torch.FloatTensor(emb).zero_())
         self.bias2 = nn.Parameter(torch.FloatTensor(numcls).zero_())
 
-    def forward(self):
+        self.restricted = None # -- targets and sliced adjacencies of the last restricted forward
 
-        ## Layer 1
+    def forward(self, targets=None):
+        """
+        :param targets: If given, only the output for these nodes is computed, in this order. The second layer is then
+            only computed for the targets, and the first only for the nodes the targets receive messages from.
+        :return: The class logits for all nodes, or for the targets.
+        """
 
-        n, rn = self.hor_graph.size()
-        r = rn // n
+        n, r = self.n, self.r
         e = self.emb
         b, c = self.bases, self.numcls
 
-        if self.bases1 is not None:
-            # weights = torch.einsum('rb, bij -> rij', self.comps1, self.bases1)
-            weights = torch.mm(self.comps1, self.bases1.view(b, n*e)).view(r, n, e)
+        if targets is None:
+            adjacency = self.adjacency()
+            hor, ver = partial(adjacency.parts, horizontal=True), adjacency.parts
+
+            # -- number of nodes computed by layer 1 and by layer 2
+            n1, n2 = n, n
         else:
-            weights = self.weights1
+            if self.restricted is None or not torch.equal(self.restricted[0], targets):
+                self.restricted = (targets,) + self.restrict(targets)
+            _, hor_graph, ver_graph = self.restricted
 
-        assert weights.size() == (r, n, e)
+            hor, ver = entries(hor_graph), entries(ver_graph)
+            n1, n2 = hor_graph.size(0), ver_graph.size(0) // r
+
+        ## Layer 1
 
         # Apply weights and sum over relations
-        h = torch.mm(self.hor_graph, weights.view(r*n, e))
-        assert h.size() == (n, e)
+        h = torch.zeros(n1, e, device=self.bias1.device)
+
+        if self.bases1 is not None:
+            # -- one basis at a time, with the component of the edge's relation folded into the edge's value:
+            #    sum_b A_b bases[b] where A_b[i, j] = A[i, (r, j)] * comps[r, b]
+            for rows, cols, vals in hor():
+                rels, nodes = cols // n, cols % n
+                coefs = self.comps1[rels] if vals is None else vals[:, None] * self.comps1[rels]
+
+                # -- the messages of each basis are recomputed in the backward, so that only one (edges, emb) matrix
+                #    is in memory at a time
+                for bi in range(b):
+                    h = h + torch.utils.checkpoint.checkpoint(aggregate, rows, nodes, coefs[:, bi], self.bases1[bi], n1,
+                                                              use_reentrant=False)
+
+        else:
+            # -- gather the weight rows of the edges (with a sparse gradient if self.sparse)
+            self.touched = []
+            for rows, cols, vals in hor():
+                cols = torch.searchsorted(self.used1, cols)
+                messages = F.embedding(cols, self.weights1, sparse=self.sparse)
+
+                h = h.index_add(0, rows, messages if vals is None else messages * vals[:, None])
+
+                if self.sparse:
+                    self.touched.append(cols)
+
+        assert h.size() == (n1, e)
 
         h = F.relu(h + self.bias1)
 
         ## Layer 2
 
-        # Multiply adjacencies by hidden
-        h = torch.mm(self.ver_graph, h) # sparse mm
-        h = h.view(r, n, e) # new dim for the relations
-
         if self.bases2 is not None:
             # weights = torch.einsum('rb, bij -> rij', self.comps2, self.bases2)
             weights = torch.mm(self.comps2, self.bases2.view(b, e * c)).view(r, e, c)
         else:
             weights = self.weights2
 
-        # Apply weights, sum over relations
-        # h = torch.einsum('rhc, rnh -> nc', weights, h)
-        h = torch.bmm(h, weights).sum(dim=0)
+        # Multiply adjacencies by hidden, apply weights, sum over relations
+        if self.csr and targets is None:
+            h = self.csr_adjacency().stacked(h, weights, checkpoint=self.checkpoint)
+        else:
+            h = kg.adjacency.stacked(ver, h, weights, n2, chunk=self.chunk, checkpoint=self.checkpoint)
 
-        assert h.size() == (n, c)
+        assert h.size() == (n2, c)
 
         return h + self.bias2 # -- softmax is applied in the loss
 
+    def adjacency(self):
+        """
+        :return: The adjacency operator, on the device of the model.
+        """
+        return kg.Adjacency(self.triples, self.n, (self.r - 1) // 2, norms=(self.out_norm, self.in_norm))
+
+    def csr_adjacency(self):
+        """
+        :return: The adjacency matrices in compressed sparse row form. These are built on first use.
+        """
+        if self.operator is None:
+            assert self.triples.device.type == 'cpu', 'The CSR kernel only runs on the CPU.'
+            self.operator = kg.CSRAdjacency(self.adjacency())
+
+        return self.operator
+
+    def restrict(self, targets):
+        """
+        Slices the adjacency matrices for a forward pass that only computes the output for the given targets.
+
+        :param targets: A vector of distinct node indices.
+        :return: The rows of the horizontally stacked adjacency matrix for the nodes that the targets receive messages
+            from (including the targets themselves, through the self-loops), and the rows of the vertically stacked
+            matrix for the targets, with the columns restricted to the same nodes.
+        """
+        n, r = self.n, self.r
+        t = targets.size(0)
+
+        adjacency = self.adjacency()
+
+        g2t = torch.full((n,), -1, dtype=torch.long, device=targets.device)
+        g2t[targets] = torch.arange(t, device=targets.device)
+        assert (g2t >= 0).sum() == t, 'Targets should be distinct.'
+
+        # Layer 2: the rows of the targets, for each relation
+        rows, src, vals = [], [], []
+        for ro, co, va in adjacency.parts():
+            rel, dst = ro // n, ro % n
+            sel = g2t[dst] >= 0
+
+            rows.append(rel[sel] * t + g2t[dst[sel]])
+            src.append(co[sel])
+            vals.append(torch.ones(sel.sum(), device=targets.device) if va is None else va[sel])
+
+        src = torch.cat(src)
+        sources = torch.unique(src)
+        g2s = torch.full((n,), -1, dtype=torch.long, device=targets.device)
+        g2s[sources] = torch.arange(sources.size(0), device=targets.device)
+
+        ver_graph = torch.sparse_coo_tensor(torch.stack([torch.cat(rows), g2s[src]]), torch.cat(vals),
+                                            size=(r*t, sources.size(0)))
+
+        # Layer 1: the rows of the nodes that layer 2 reads from
+        rows, cols, vals = [], [], []
+        for ro, co, va in adjacency.parts(horizontal=True):
+            sel = g2s[ro] >= 0
+
+            rows.append(g2s[ro[sel]])
+            cols.append(co[sel])
+            vals.append(torch.ones(sel.sum(), device=targets.device) if va is None else va[sel])
+
+        hor_graph = torch.sparse_coo_tensor(torch.stack([torch.cat(rows), torch.cat(cols)]), torch.cat(vals),
+                                            size=(sources.size(0), r*n))
+
+        return hor_graph, ver_graph
+
     def penalty(self, p=2):
 
         assert p==2
 
+        if self.bases is None and self.sparse:
+            # -- only the rows used in the last forward, to keep the gradient sparse
+            return F.embedding(torch.unique(torch.cat(self.touched)), self.weights1, sparse=True).pow(2).sum()
+
         if self.bases is None:
             return self.weights1.pow(2).sum()
 
         return self.comps1.pow(p).sum() + self.bases1.pow(p).sum()
 
-def go(name='am1k', lr=0.01, wd=0.0, l2=0.0, epochs=50, prune=False, optimizer='adam', final=False, emb=16, bases=None, printnorms=None):
+    def norms1(self):
+        """
+        :return: The norm of the weights of the first layer for each relation.
+        """
+        if self.bases is not None:
+            return self.comps1.norm(dim=1)
+
+        sq = torch.bincount(self.used1 // self.n, weights=self.weights1.detach().pow(2).sum(dim=1), minlength=self.r)
+        return sq.sqrt()
+
+class Optimizers:
+    """
+    Steps several optimizers as one.
+    """
+
+    def __init__(self, *optimizers):
+        self.optimizers = optimizers
+
+    def zero_grad(self):
+        for opt in self.optimizers:
+            opt.zero_grad()
+
+    def step(self):
+        for opt in self.optimizers:
+            opt.step()
+
+def go(name='am1k', lr=0.01, wd=0.0, l2=0.0, epochs=50, prune=False, optimizer='adam', final=False, emb=16, bases=None, printnorms=None, restrict=False, sparse=False, chunk=None, checkpoint=False, csr=False, compact=None, min_count=None, merge=True):
 
     data = load(name, torch=True, prune_dist=2 if prune else None, final=final)
 
+    if compact is not None or min_count is not None:
+        data = kg.compact(data, k=compact, min_count=min_count, merge=merge)
+        print(f'compacted to {data.num_relations} relations')
+
     print(f'{data.triples.size(0)} triples')
     print(f'{data.num_entities} entities')
     print(f'{data.num_relations} relations')
 
     tic()
-    rgcn = RGCN(data.triples, n=data.num_entities, r=data.num_relations, numcls=data.num_classes, emb=emb, bases=bases)
+    adjacency = kg.Adjacency(data.triples, data.num_entities, data.num_relations)
+    print(f'adjacency: {toc():.5}s')
+
+    tic()
+    rgcn = RGCN(data.triples, n=data.num_entities, r=data.num_relations, numcls=data.num_classes, emb=emb, bases=bases,
+                adjacency=adjacency, sparse=sparse and bases is None, chunk=chunk, checkpoint=checkpoint,
+                csr=csr and not torch.cuda.is_available())
 
     if torch.cuda.is_available():
         print('Using cuda.')
@@ -228,30 +417,39 @@ def go(name='am1k', lr=0.01, wd=0.0, l2=0.0, epochs=50, prune=False, optimizer='
 
     print(f'construct: {toc():.5}s')
 
+    params = [p for p in rgcn.parameters() if not (rgcn.sparse and p is rgcn.weights1)]
+
     if optimizer == 'adam':
-        opt = torch.optim.Adam(lr=lr, weight_decay=wd, params=rgcn.parameters())
+        opt = torch.optim.Adam(lr=lr, weight_decay=wd, params=params)
     elif optimizer == 'adamw':
-        opt = torch.optim.AdamW(lr=lr, weight_decay=wd, params=rgcn.parameters())
+        opt = torch.optim.AdamW(lr=lr, weight_decay=wd, params=params)
     else:
         raise Exception(f'Optimizer {optimizer} not known')
 
+    if rgcn.sparse: # -- the sparse gradient of the first layer only updates the rows that were used
+        opt = Optimizers(opt, torch.optim.SparseAdam(lr=lr, params=[rgcn.weights1]))
+
     for e in range(epochs):
         tic()
         opt.zero_grad()
-        out = rgcn()
-
         idxt, clst = data.training[:, 0], data.training[:, 1]
         idxw, clsw = data.withheld[:, 0], data.withheld[:, 1]
 
-        out_train = out[idxt, :]
+        if restrict: # -- only compute the output for the labeled nodes
+            out = rgcn(torch.cat([idxt, idxw]))
+            out_train, out_withheld = out[:idxt.size(0)], out[idxt.size(0):]
+        else:
+            out = rgcn()
+            out_train, out_withheld = out[idxt, :], out[idxw, :]
+
         loss = F.cross_entropy(out_train, clst, reduction='mean')
         if l2 != 0.0:
             loss = loss + l2 * rgcn.penalty()
 
         # compute performance metrics
         with torch.no_grad():
-            training_acc = (out[idxt, :].argmax(dim=1) == clst).sum().item() / idxt.size(0)
-            withheld_acc = (out[idxw, :].argmax(dim=1) == clsw).sum().item() / idxw.size(0)
+            training_acc = (out_train.argmax(dim=1) == clst).sum().item() / idxt.size(0)
+            withheld_acc = (out_withheld.argmax(dim=1) == clsw).sum().item() / idxw.size(0)
 
         loss.backward()
         opt.step()
@@ -259,7 +457,7 @@ def go(name='am1k', lr=0.01, wd=0.0, l2=0.0, epochs=50, prune=False, optimizer='
         if printnorms is not None:
             # Print relation norms layer 1
             nr = data.num_relations
-            weights = rgcn.weights1 if bases is None else rgcn.comps1
+            weights = rgcn.norms1()
 
             ctr = Counter()
 
@@ -0,0 +1,168 @@
+"""
+Run a hyperparameter sweep of the RGCN or MRGCN baseline of the given dataset.
+
+The dataset is loaded (and pruned) once, and the triples, the labels and the adjacency operator (and for the MRGCN, the
+node embeddings) are moved to shared memory. A pool of trainer processes attaches to these without copying them, and
+trains one configuration at a time. The results are collected in one table.
+"""
+
+import fire, sys, itertools
+
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+from kgbench import load, tic, toc
+import kgbench as kg
+
+import rgcn
+
+MODELS = ['rgcn', 'mrgcn']
+
+SHARED = None
+# -- The shared data, in each trainer process.
+
+def attach(shared, threads):
+    """
+    Initializes a trainer process.
+    """
+    global SHARED
+    SHARED = shared
+
+    torch.set_num_threads(threads)
+
+def train(config):
+    """
+    Trains one configuration on the shared data.
+
+    :param config: A dict with the hyperparameters.
+    :return: The config, extended with the results of the last epoch.
+    """
+    adjacency, training, withheld = SHARED['adjacency'], SHARED['training'], SHARED['withheld']
+    n, r, numcls = adjacency.num_nodes, adjacency.num_relations, SHARED['num_classes']
+
+    torch.manual_seed(config['seed'])
+
+    if SHARED['model'] == 'rgcn':
+        model = rgcn.RGCN(adjacency.triples, n=n, r=r, numcls=numcls, emb=config['emb'], bases=config['bases'],
+                          adjacency=adjacency, csr=SHARED['csr'])
+        inputs = ()
+    else:
+        import mrgcn
+
+        # -- as in mrgcn.py, the node embeddings are fixed
+        features = SHARED['embeddings'][config['emb']]
+        model = mrgcn.RGCN(adjacency.triples, n=n, r=r, insize=config['emb'], hidden=config['emb'], numcls=numcls,
+                           bases=config['bases'], adjacency=adjacency, csr=SHARED['csr'])
+        inputs = (features, )
+
+    opt = torch.optim.Adam(lr=config['lr'], params=model.parameters())
+
+    idxt, clst = training[:, 0], training[:, 1]
+    idxw, clsw = withheld[:, 0], withheld[:, 1]
+
+    tic()
+    for e in range(SHARED['epochs']):
+        opt.zero_grad()
+
+        out = model(*inputs)
+        out_train, out_withheld = out[idxt, :], out[idxw, :]
+
+        loss = F.cross_entropy(out_train, clst, reduction='mean')
+        if config['l2'] != 0.0:
+            loss = loss + config['l2'] * model.penalty()
+
+        with torch.no_grad():
+            training_acc = (out_train.argmax(dim=1) == clst).sum().item() / idxt.size(0)
+            withheld_acc = (out_withheld.argmax(dim=1) == clsw).sum().item() / idxw.size(0)
+
+        loss.backward()
+        opt.step()
+
+    return dict(config, loss=loss.item(), train_acc=training_acc, withheld_acc=withheld_acc,
+                epoch_time=toc() / SHARED['epochs'])
+
+def values(v):
+    return list(v) if type(v) in (list, tuple) else [v]
+
+def share(data, model, epochs, csr=False, emb=16, **embedargs):
+    """
+    Moves the data needed by the trainer processes to shared memory.
+
+    :param emb: For the MRGCN, the embedding size (or a list of sizes) to compute the node embeddings for.
+    :param embedargs: Arguments for the literal encoders (see `mrgcn.embed()`).
+    :return: A dict of the shared data.
+    """
+    shared = {
+        'model': model, 'epochs': epochs, 'csr': csr, 'num_classes': data.num_classes,
+        'adjacency': kg.Adjacency(data.triples, data.num_entities, data.num_relations).share_memory_(),
+        'training': data.training.share_memory_(), 'withheld': data.withheld.share_memory_()
+    }
+
+    if model == 'mrgcn':
+        import mrgcn
+
+        shared['embeddings'] = {e: mrgcn.embed(data, e, **embedargs).cpu().share_memory_() for e in values(emb)}
+
+    return shared
+
+def sweep(shared, configs, workers=2, threads=1):
+    """
+    Trains the given configurations in a pool of trainer processes.
+
+    :return: A list of results (see `train()`), in order of completion.
+    """
+    results = []
+    with mp.get_context('spawn').Pool(workers, initializer=attach, initargs=(shared, threads)) as pool:
+        for result in pool.imap_unordered(train, configs):
+            results.append(result)
+            print(f'run {len(results):03}/{len(configs)}: ' +
+                  ', '.join(f'{k} {v:.4}' if type(v) == float else f'{k} {v}' for k, v in result.items()))
+
+    return results
+
+def go(name='amplus', model='rgcn', lr=(0.01, 0.001), l2=(0.0, 5e-4), emb=16, bases=None, repeats=1, epochs=50,
+       prune=True, final=False, workers=2, threads=1, csr=False, out=None, imagebatch=256, stringbatch=50_000,
+       imageworkers=4, imagecache=True):
+    """
+    :param lr: A learning rate, or a list of learning rates to try. Likewise for `l2`, `emb` and `bases`.
+    :param repeats: The number of runs of each configuration, with different seeds.
+    :param workers: The number of trainer processes.
+    :param threads: The number of pytorch threads in each trainer process.
+    :param csr: Use the CSR kernel for the second layer (see `kg.CSRAdjacency`). This is built in each trainer process.
+    :param out: If given, the table of results is also written to this CSV file.
+    """
+    assert model in MODELS, f'Model {model} not recognized. Should be one of {MODELS}.'
+
+    tic()
+    data = load(name, torch=True, prune_dist=2 if prune else None, final=final)
+    if model == 'mrgcn':
+        data = kg.group(data)
+
+    print(f'{data.triples.size(0)} triples')
+    print(f'{data.num_entities} entities')
+    print(f'{data.num_relations} relations')
+    print(f'loaded: {toc():.5}s')
+
+    shared = share(data, model, epochs, csr=csr, emb=emb, imagebatch=imagebatch, stringbatch=stringbatch,
+                   imageworkers=imageworkers, imagecache=imagecache)
+
+    configs = [{'lr': a, 'l2': b, 'emb': c, 'bases': d, 'seed': s} for a, b, c, d, s in
+               itertools.product(values(lr), values(l2), values(emb), values(bases), range(repeats))]
+
+    print(f'{len(configs)} runs on {workers} workers.')
+
+    tic()
+    results = sweep(shared, configs, workers=workers, threads=threads)
+    print(f'sweep finished: {toc():.5}s')
+
+    table = pd.DataFrame(results).sort_values('withheld_acc', ascending=False)
+    print(table.to_string(index=False))
+
+    if out is not None:
+        table.to_csv(out, index=False)
+
+if __name__ == '__main__':
+
+    print('arguments ', ' '.join(sys.argv))
+    fire.Fire(go)
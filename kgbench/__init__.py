@@ -1,5 +1,12 @@
-from .load import load, Data, prune, group, datatype_key
+from .load import load, Data, prune, group, reorder, compact, reindex, datatype_key, load_triples, fastload, load_entities
 
-from .util import load_rdf, tic, toc, d, to_tensorbatch, to_tensorbatches, to_tvbatches, to_tvbatch, entity, entity_hdt, n3
+from .nodes import NodeTable, FrontCodedDict
+from .csr import CSR
+from .sampler import NeighborSampler, Sample, Block
+from .adjacency import Adjacency, CSRAdjacency
+
+from .images import Images
+
+from .util import load_rdf, tic, toc, d, to_tensorbatch, to_tensorbatches, to_tvbatches, to_tvbatch, size_order, padding, entity, entity_hdt, n3
 
 from .parse import parse_term, Resource, Entity, Literal, BNode, IRIRef
\ No newline at end of file
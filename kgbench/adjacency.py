@@ -0,0 +1,399 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.utils.checkpoint
+
+"""
+Adjacency operators for relational message passing, with implicit inverse edges and self-loops.
+"""
+
+class Adjacency:
+    """
+    The normalized adjacency matrices of a knowledge graph with r relations, extended with an inverse for each relation
+    and a self-loop relation, for 2r+1 relations in total.
+
+    A node receives messages along its edges: for every triple (s, p, o), node s receives from node o with relation p
+    and node o receives from node s with relation r + p. Every node receives from itself with relation 2r. The rows of
+    each matrix sum to one, so the entry for a triple is one over the number of triples with the same subject and
+    relation (for relation p), or with the same object and relation (for relation r + p). Self-loops have value one.
+
+    Only the triples are stored, together with these two normalization values per triple. The entries of the inverse
+    relations are the transposed forward entries, and the self-loops are an identity term; both are computed on the fly
+    by `parts()`.
+
+    The matrices are stacked as in the RGCN baselines: vertically, into a (R*n, n) matrix with the matrix of relation p
+    at rows p*n to (p+1)*n, or horizontally, into a (n, R*n) matrix with the matrix of relation p at columns p*n to
+    (p+1)*n.
+    """
+
+    def __init__(self, triples, num_nodes, num_relations, norms=None):
+        """
+        :param triples: An (m, 3) integer tensor or array of triples.
+        :param num_relations: The number of relations in the triples (without inverses and self-loops).
+        :param norms: The normalization values of the forward and inverse entries, as computed by `normalize()`, if
+            these are already available.
+        """
+        self.triples = torch.as_tensor(triples).long()
+        self.num_nodes, self.num_relations = num_nodes, num_relations
+
+        self.out_norm, self.in_norm = normalize(self.triples, num_nodes, num_relations) if norms is None else norms
+
+    @property
+    def num_stacked(self):
+        """
+        :return: The number of stacked matrices: relations, inverse relations and self-loops.
+        """
+        return 2 * self.num_relations + 1
+
+    def to(self, device):
+        return Adjacency(self.triples.to(device), self.num_nodes, self.num_relations,
+                         norms=(self.out_norm.to(device), self.in_norm.to(device)))
+
+    def share_memory_(self):
+        for t in (self.triples, self.out_norm, self.in_norm):
+            t.share_memory_()
+
+        return self
+
+    def parts(self, horizontal=False):
+        """
+        Generates the nonzero entries of the stacked matrix in three parts: those of the relations, of the inverse
+        relations and of the self-loops. The index tensors are computed when each part is generated.
+
+        :param horizontal: Index the horizontally stacked matrix instead of the vertically stacked one.
+        :return: A generator of (rows, cols, vals) tuples. The values of the self-loops are None, meaning all ones.
+        """
+        n, r = self.num_nodes, self.num_relations
+        s, p, o = self.triples[:, 0], self.triples[:, 1], self.triples[:, 2]
+
+        if horizontal:
+            yield s, p * n + o, self.out_norm
+            yield o, (p + r) * n + s, self.in_norm
+        else:
+            yield p * n + s, o, self.out_norm
+            yield (p + r) * n + o, s, self.in_norm
+
+        nodes = torch.arange(n, device=self.triples.device)
+        yield (nodes, 2 * r * n + nodes, None) if horizontal else (2 * r * n + nodes, nodes, None)
+
+    def explicit(self, horizontal=False):
+        """
+        :return: The stacked matrix as a sparse tensor, with its entries in the order of `parts()`.
+        """
+        n, rr = self.num_nodes, self.num_stacked
+        rows, cols, vals = zip(*self.parts(horizontal))
+
+        vals = vals[:-1] + (torch.ones(n, device=self.out_norm.device, dtype=self.out_norm.dtype),)
+        size = (n, rr * n) if horizontal else (rr * n, n)
+
+        return torch.sparse_coo_tensor(torch.stack([torch.cat(rows), torch.cat(cols)]), torch.cat(vals), size=size)
+
+    def horizontal(self, w):
+        """
+        :param w: An (R*n, e) matrix.
+        :return: The product of the horizontally stacked matrix with w, an (n, e) matrix.
+        """
+        return spmm(self.parts(horizontal=True), w, self.num_nodes)
+
+    def vertical(self, h):
+        """
+        :param h: An (n, e) matrix.
+        :return: The product of the vertically stacked matrix with h, an (R*n, e) matrix.
+        """
+        return spmm(self.parts(), h, self.num_stacked * self.num_nodes)
+
+    def stacked(self, h, weights, chunk=None, checkpoint=False):
+        """
+        :return: The sum over all relations p of A_p h W_p. See `stacked()`.
+        """
+        return stacked(self.parts, h, weights, self.num_nodes, chunk=chunk, checkpoint=checkpoint)
+
+    def propagate(self, x, nodes, hops=2, chunk=None, out=None):
+        """
+        Precomputes the inputs of a SIGN-style model: the features propagated along each relation, for up to `hops`
+        hops, but only for the given nodes.
+
+        Hop k computes A_p h for every relation p, where h is x for the first hop, and for later hops the mean over the
+        relations that a node has (including the self-loop) of the results of the previous hop.
+
+        :param x: An (n, d) feature matrix.
+        :param nodes: The nodes to return the propagated features of.
+        :param chunk: Propagate along this many relations at a time, to bound the size of the intermediate values.
+        :param out: A float numpy array of shape (len(nodes), hops, R, d) to write the result to, for instance a
+            memory-mapped array. If None, one is allocated.
+        :return: The array containing for each node, hop and relation the propagated features.
+        """
+        n, rr, d = self.num_nodes, self.num_stacked, x.size(1)
+        chunk = rr if chunk is None else chunk
+
+        nodes = torch.as_tensor(nodes, device=x.device).long()
+        out = np.empty((nodes.size(0), hops, rr, d), dtype=np.float32) if out is None else out
+
+        # -- the number of relations of each node, with the self-loop
+        rows = torch.cat([rows for rows, _, vals in self.parts() if vals is not None])
+        counts = torch.bincount(torch.unique(rows) % n, minlength=n) + 1
+
+        h = x
+        with torch.no_grad():
+            for k in range(hops):
+                nxt = torch.zeros_like(h)
+
+                for fr in range(0, rr, chunk):
+                    to = min(fr + chunk, rr)
+                    hp = spmm(select(self.parts(), fr, to, n), h, (to - fr) * n).view(to - fr, n, d)
+
+                    out[:, k, fr:to] = hp[:, nodes].transpose(0, 1).cpu().numpy()
+                    nxt += hp.sum(dim=0)
+
+                h = nxt / counts[:, None]
+
+        return out
+
+def normalize(triples, num_nodes, num_relations):
+    """
+    :param triples: An (m, 3) long tensor.
+    :return: For each triple, one over the number of triples with the same subject and relation, and one over the number
+        of triples with the same object and relation.
+    """
+    s, p, o = triples[:, 0], triples[:, 1], triples[:, 2]
+
+    norms = []
+    for node in (s, o):
+        _, inverse, counts = torch.unique(node * num_relations + p, return_inverse=True, return_counts=True)
+        norms.append(1.0 / counts[inverse].float())
+
+    return tuple(norms)
+
+def spmm(parts, h, num_rows):
+    """
+    Multiplies a sparse matrix, given as a sequence of (rows, cols, vals) parts (see `Adjacency.parts()`), with a dense
+    matrix.
+
+    :param num_rows: The number of rows of the sparse matrix.
+    """
+    result = h.new_zeros(num_rows, h.size(1))
+
+    for rows, cols, vals in parts:
+        result.index_add_(0, rows, h[cols] if vals is None else h[cols] * vals[:, None])
+
+    return result
+
+def select(parts, fr, to, n):
+    """
+    Selects the entries of the matrices of relations fr up to to from the parts of a vertically stacked matrix, with
+    rows of n nodes per relation. The row indices are shifted so that they start at zero.
+    """
+    for rows, cols, vals in parts:
+        sel = (rows >= fr * n) & (rows < to * n)
+        yield rows[sel] - fr * n, cols[sel], None if vals is None else vals[sel]
+
+def stacked(parts, h, weights, n, chunk=None, checkpoint=False):
+    """
+    Computes the sum over all relations p of A_p h W_p, where the A_p are the (n, m) matrices in a vertically stacked
+    matrix.
+
+    :param parts: A function that returns the parts of the vertically stacked matrix (like `Adjacency.parts`).
+    :param h: An (m, e) matrix.
+    :param weights: An (R, e, c) tensor of weight matrices, one for each relation.
+    :param chunk: Compute the sum for this many relations at a time. This reduces the size of the intermediate values
+        from R x n x e to chunk x n x e.
+    :param checkpoint: Recompute the intermediate values of each chunk in the backward pass instead of keeping them in
+        memory.
+    :return: An (n, c) matrix.
+    """
+    rr = weights.size(0)
+    chunk = rr if chunk is None else chunk
+
+    result = 0
+    for fr in range(0, rr, chunk):
+        to = min(fr + chunk, rr)
+
+        if checkpoint:
+            result = result + torch.utils.checkpoint.checkpoint(block, parts, h, weights, fr, to, n, use_reentrant=False)
+        else:
+            result = result + block(parts, h, weights, fr, to, n)
+
+    return result
+
+def block(parts, h, weights, fr, to, n):
+    """
+    :return: The sum of A_p h W_p for the relations fr up to to.
+    """
+    entries = parts() if (fr, to) == (0, weights.size(0)) else select(parts(), fr, to, n)
+
+    h = spmm(entries, h, (to - fr) * n).view(to - fr, n, h.size(1))
+    return torch.bmm(h, weights[fr:to]).sum(dim=0)
+
+class CSRAdjacency:
+    """
+    The matrices of an `Adjacency`, stored in compressed sparse row form for fast products on the CPU.
+
+    The nonzero rows of the vertically stacked matrix are stored grouped by relation. Only the rows of nodes that receive
+    a message along a relation are stored for that relation. `stacked()` multiplies each row with the weight matrix of
+    its relation and adds it to the row of its node in the output, so that the (R*n, e) intermediate of the vertically
+    stacked product is never built.
+
+    The work is split over a pool of threads by ranges of rows: in the forward pass by ranges of destination nodes, in
+    the backward pass by ranges of source nodes, so that each thread writes to its own rows of the result.
+    """
+
+    def __init__(self, adjacency, threads=None):
+        """
+        :param adjacency: An `Adjacency`.
+        :param threads: The number of threads to use. Defaults to `torch.get_num_threads()`.
+        """
+        n, rr = adjacency.num_nodes, adjacency.num_stacked
+        self.num_nodes, self.num_stacked = n, rr
+        self.threads = torch.get_num_threads() if threads is None else threads
+
+        ones = lambda size : torch.ones(size, dtype=adjacency.out_norm.dtype, device=adjacency.out_norm.device)
+        parts = [(rows, cols, ones(rows.size(0)) if vals is None else vals) for rows, cols, vals in adjacency.parts()]
+        rows, cols, vals = (torch.cat(x) for x in zip(*parts))
+
+        # Forward: the rows of each thread, sorted by relation and node
+        dst = rows % n
+        bounds = ranges(dst, n, self.threads)
+
+        key = torch.bucketize(dst, torch.tensor(bounds[1:-1], dtype=torch.long), right=True) * (rr * n) + rows
+        order = torch.argsort(key, stable=True)
+        key, cols, vals = key[order], cols[order], vals[order]
+
+        key, counts = torch.unique_consecutive(key, return_counts=True)
+        pointers = torch.cat([counts.new_zeros(1), torch.cumsum(counts, dim=0)])
+        thread, rel, node = key // (rr * n), (key % (rr * n)) // n, key % n
+
+        tbounds = torch.searchsorted(thread, torch.arange(self.threads + 1)).tolist()
+
+        self.csr, self.nodes, self.segments = [], [], []
+        for t in range(self.threads):
+            fr, to = tbounds[t], tbounds[t+1]
+            a, b = pointers[fr].item(), pointers[to].item()
+
+            self.csr.append(torch.sparse_csr_tensor(index(pointers[fr:to+1] - a), index(cols[a:b]), vals[a:b],
+                                                    size=(to - fr, n)))
+            self.nodes.append(node[fr:to] - bounds[t])
+
+            rels, rcounts = torch.unique_consecutive(rel[fr:to], return_counts=True)
+            ends = torch.cumsum(rcounts, dim=0)
+            self.segments.append(list(zip(rels.tolist(), (ends - rcounts).tolist(), ends.tolist())))
+
+        self.bounds = bounds
+
+        # Backward: the transposed matrix, from the compact rows to the source nodes, split by ranges of source nodes
+        k = torch.repeat_interleave(torch.arange(key.size(0)), counts)
+        sbounds = ranges(cols, n, self.threads)
+
+        order = torch.argsort(cols, stable=True)
+        srcs, k, tvals = cols[order], k[order], vals[order]
+
+        tpointers = torch.cat([counts.new_zeros(1), torch.cumsum(torch.bincount(srcs, minlength=n), dim=0)])
+
+        self.transposed = []
+        for t in range(self.threads):
+            fr, to = sbounds[t], sbounds[t+1]
+            a, b = tpointers[fr].item(), tpointers[to].item()
+
+            self.transposed.append(torch.sparse_csr_tensor(index(tpointers[fr:to+1] - a), index(k[a:b]), tvals[a:b],
+                                                           size=(to - fr, key.size(0))))
+
+        self.pool = ThreadPoolExecutor(max_workers=self.threads) if self.threads > 1 else None
+
+    def map(self, function):
+        """
+        :return: The results of calling the function with each thread index, in a thread of the pool.
+        """
+        if self.pool is None:
+            return [function(t) for t in range(self.threads)]
+
+        return list(self.pool.map(function, range(self.threads)))
+
+    def stacked(self, h, weights, chunk=None, checkpoint=False):
+        """
+        :return: The sum over all relations p of A_p h W_p. The chunk argument is ignored, since this product has no
+            intermediate values per relation and node.
+        :param checkpoint: Recompute the product of the matrix with h in the backward pass, instead of keeping it in
+            memory.
+        """
+        return StackedCSR.apply(h, weights, self, checkpoint)
+
+    def __getstate__(self):
+        # -- thread pools can't be sent to other processes
+        state = dict(self.__dict__)
+        state['pool'] = None
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pool = ThreadPoolExecutor(max_workers=self.threads) if self.threads > 1 else None
+
+def ranges(nodes, n, k):
+    """
+    :return: The boundaries of k ranges of nodes, with about the same number of occurrences in `nodes` each.
+    """
+    cumulative = torch.cumsum(torch.bincount(nodes, minlength=n), dim=0)
+    inner = torch.searchsorted(cumulative, torch.arange(1, k) * nodes.size(0) // k, right=True)
+
+    return [0] + inner.tolist() + [n]
+
+def index(t):
+    """
+    Converts an index tensor to 32 bit integers, if its values allow it, for faster sparse products.
+    """
+    return t.int() if t.numel() == 0 or t.max() < 2**31 else t
+
+class StackedCSR(torch.autograd.Function):
+    """
+    The product `CSRAdjacency.stacked()`, with the gradients for h and the weights.
+    """
+
+    @staticmethod
+    def forward(ctx, h, weights, adjacency, checkpoint):
+
+        def part(t):
+            y = adjacency.csr[t] @ h
+            result = h.new_zeros(adjacency.bounds[t+1] - adjacency.bounds[t], weights.size(2))
+
+            nodes = adjacency.nodes[t]
+            for rel, fr, to in adjacency.segments[t]:
+                result.index_add_(0, nodes[fr:to], y[fr:to] @ weights[rel])
+
+            return result, y
+
+        results, ys = zip(*adjacency.map(part))
+
+        ctx.save_for_backward(h, weights)
+        ctx.adjacency, ctx.ys = adjacency, None if checkpoint else ys
+
+        return torch.cat(results, dim=0)
+
+    @staticmethod
+    def backward(ctx, grad):
+        h, weights = ctx.saved_tensors
+        adjacency = ctx.adjacency
+        ys = ctx.ys
+
+        def part(t):
+            y = adjacency.csr[t] @ h if ys is None else ys[t]
+            g = grad[adjacency.bounds[t]:adjacency.bounds[t+1]]
+
+            grad_y, grad_weights = torch.empty_like(y), torch.zeros_like(weights)
+
+            nodes = adjacency.nodes[t]
+            for rel, fr, to in adjacency.segments[t]:
+                gn = g[nodes[fr:to]]
+
+                grad_y[fr:to] = gn @ weights[rel].t()
+                grad_weights[rel] += y[fr:to].t() @ gn
+
+            return grad_y, grad_weights
+
+        grad_ys, grad_weights = zip(*adjacency.map(part))
+
+        grad_h = None
+        if ctx.needs_input_grad[0]:
+            grad_y = torch.cat(grad_ys, dim=0)
+            grad_h = torch.cat(adjacency.map(lambda t: adjacency.transposed[t] @ grad_y), dim=0)
+
+        return grad_h, sum(grad_weights), None, None
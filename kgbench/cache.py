@@ -0,0 +1,174 @@
+import os, json, tempfile, warnings
+from os.path import join, basename, exists
+
+import numpy as np
+
+"""
+Persistent binary caching of arrays derived from the dataset files.
+
+A cache entry consists of a small JSON header and one .npy file per array. The header records the cache format version,
+a fingerprint (size and modification time) of every source file the arrays were derived from, and any settings used to
+derive them. If any of these differ from what the caller expects, the entry is rebuilt.
+
+Every file is written to a temporary file in the cache directory first and then atomically moved into place, with the
+header going last. Several processes building the same entry at once will each write a complete copy and the last
+rename wins, so a reader never sees a partially written file.
+"""
+
+VERSION = 1
+
+CACHE_DIR = '.cache'
+
+def cache_dir(dir):
+    """
+    :param dir: A dataset directory.
+    :return: The directory in which cached arrays for the given dataset are stored.
+    """
+    return join(dir, CACHE_DIR)
+
+def fingerprint(file):
+    """
+    Returns a cheap fingerprint of a file, used to detect whether it has changed since a cache entry was written.
+
+    :param file:
+    :return: A dict with the file name, size in bytes and modification time in nanoseconds.
+    """
+    stat = os.stat(file)
+    return {'file': basename(file), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+def cached(dir, name, sources, build, settings=None):
+    """
+    Returns the arrays produced by `build`, loading them from the cache in `dir` if a valid entry exists, and building and
+    writing the entry if not.
+
+    Arrays loaded from the cache are memory-mapped copy-on-write: they load in constant time, and may be modified in
+    memory without the changes being written back to disk.
+
+    :param dir: The cache directory (see `cache_dir()`).
+    :param name: Name of the cache entry.
+    :param sources: A list of files from which the arrays are derived. The entry is invalidated if any of these change.
+    :param build: A function without arguments returning a dict from names to numpy arrays.
+    :param settings: A JSON-serializable dict of any other settings the arrays depend on.
+    :return: A dict from names to numpy arrays.
+    """
+
+    header = {
+        'version': VERSION,
+        'sources': [fingerprint(source) for source in sources],
+        'settings': settings
+    }
+
+    arrays = load_entry(dir, name, header)
+    if arrays is not None:
+        return arrays
+
+    arrays = build()
+
+    try:
+        write_entry(dir, name, header, arrays)
+    except OSError as e:
+        warnings.warn(f'Could not write cache entry {name} to {dir} ({e}). Continuing without cache.')
+
+    return arrays
+
+def cached_array(dir, name, sources, shape, dtype, fill, settings=None):
+    """
+    Like `cached()`, for a single array that may be too large to build in memory. The array is created as a
+    memory-mapped file in the cache directory and filled in place by `fill`.
+
+    :param shape: The shape of the array.
+    :param dtype: The numpy dtype of the array.
+    :param fill: A function that takes a writable array of the given shape and dtype and fills it.
+    :return: The memory-mapped array.
+    """
+
+    header = {
+        'version': VERSION,
+        'sources': [fingerprint(source) for source in sources],
+        'settings': settings
+    }
+
+    arrays = load_entry(dir, name, header)
+    if arrays is not None:
+        return arrays['array']
+
+    try:
+        os.makedirs(dir, exist_ok=True)
+        path = join(dir, f'{name}.array.npy')
+
+        fd, tmp = tempfile.mkstemp(dir=dir, prefix=f'.{name}.array.npy.', suffix='.tmp')
+        os.close(fd)
+        try:
+            out = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=tuple(shape))
+            fill(out)
+            out.flush()
+            del out
+
+            os.replace(tmp, path)
+        except BaseException:
+            if exists(tmp):
+                os.remove(tmp)
+            raise
+
+        stored = dict(header, arrays=['array'])
+        replace(join(dir, f'{name}.json'), lambda file: file.write(json.dumps(stored).encode('utf-8')))
+
+    except OSError as e:
+        warnings.warn(f'Could not write cache entry {name} to {dir} ({e}). Continuing without cache.')
+
+        out = np.empty(shape, dtype=dtype)
+        fill(out)
+        return out
+
+    return load_entry(dir, name, header)['array']
+
+def load_entry(dir, name, header):
+    """
+    Loads a cache entry if it exists and its header matches the given header.
+
+    :return: A dict of memory-mapped arrays, or None if there is no valid entry.
+    """
+
+    try:
+        with open(join(dir, f'{name}.json'), 'r') as file:
+            stored = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    keys = stored.pop('arrays', None)
+    if stored != header or keys is None:
+        return None
+
+    try:
+        return {key: np.load(join(dir, f'{name}.{key}.npy'), mmap_mode='c') for key in keys}
+    except (OSError, ValueError):
+        return None
+
+def write_entry(dir, name, header, arrays):
+    """
+    Writes a cache entry. The arrays are written first, and the header last, so that the header only refers to complete
+    files.
+    """
+
+    os.makedirs(dir, exist_ok=True)
+
+    for key, array in arrays.items():
+        replace(join(dir, f'{name}.{key}.npy'), lambda file: np.save(file, np.ascontiguousarray(array)))
+
+    header = dict(header, arrays=list(arrays.keys()))
+    replace(join(dir, f'{name}.json'), lambda file: file.write(json.dumps(header).encode('utf-8')))
+
+def replace(path, write):
+    """
+    Atomically replaces the file at `path` with the content written to a binary file object by `write`.
+    """
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f'.{basename(path)}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            write(file)
+        os.replace(tmp, path)
+    except BaseException:
+        if exists(tmp):
+            os.remove(tmp)
+        raise
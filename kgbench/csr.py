@@ -0,0 +1,130 @@
+import numpy as np
+import torch
+
+"""
+Compressed sparse row (CSR) indices of the edges of a knowledge graph.
+"""
+
+DIRECTIONS = ['out', 'in']
+
+class CSR:
+    """
+    The edges of a graph, grouped by node and sorted by (node, relation). For the outgoing edges, the node is the
+    subject of the triple and the neighbor is the object. For the incoming edges, it's the other way around.
+
+    The edges of node i are at positions `pointers[i]` to `pointers[i+1]` of the edge arrays. Within these, edges with
+    the same relation are consecutive, and edges with the same node and relation are in the order of the triples.
+
+    All queries for a single node take time proportional to its degree (or, when filtered by relation, logarithmic in
+    its degree plus the size of the result), and return views rather than copies.
+    """
+
+    def __init__(self, pointers, relations, neighbors, edges):
+        """
+        :param pointers: An array of n+1 offsets into the edge arrays.
+        :param relations: The relation of each edge.
+        :param neighbors: The neighbor of each edge.
+        :param edges: The index of each edge in the triples it was built from.
+        """
+        self.pointers = pointers
+        self.relations = relations
+        self.neighbors = neighbors
+        self.edges = edges
+
+    @staticmethod
+    def from_triples(triples, num_nodes, num_relations, direction='out'):
+        """
+        :param triples: An (m, 3) integer array of triples.
+        :param direction: 'out' to index the edges by subject, 'in' to index them by object.
+        """
+        assert direction in DIRECTIONS, f'Direction {direction} not recognized. Should be one of {DIRECTIONS}.'
+
+        triples = np.asarray(triples)
+        node, nb = (0, 2) if direction == 'out' else (2, 0)
+
+        # -- a stable sort on a single (node, relation) key
+        key = triples[:, node].astype(np.int64) * num_relations + triples[:, 1]
+        edges = np.argsort(key, kind='stable')
+
+        pointers = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(triples[:, node], minlength=num_nodes), out=pointers[1:])
+
+        return CSR(pointers,
+                   triples[edges, 1].astype(np.int64),
+                   triples[edges, nb].astype(np.int64),
+                   edges.astype(np.int64))
+
+    def __len__(self):
+        """
+        :return: The number of nodes.
+        """
+        return self.pointers.shape[0] - 1
+
+    def degrees(self):
+        """
+        :return: The number of edges of each node.
+        """
+        return np.diff(self.pointers)
+
+    def degree(self, node):
+        return int(self.pointers[node + 1] - self.pointers[node])
+
+    def span(self, node, relation=None):
+        """
+        :return: The start and end position of the edges of the given node, with the given relation if one is given.
+        """
+        fr, to = int(self.pointers[node]), int(self.pointers[node + 1])
+
+        if relation is not None:
+            rels = self.relations[fr:to]
+            fr, to = fr + int(np.searchsorted(rels, relation, side='left')), \
+                     fr + int(np.searchsorted(rels, relation, side='right'))
+
+        return fr, to
+
+    def neighbors_of(self, node, relation=None):
+        """
+        :return: The neighbors of the given node, over all edges or only those with the given relation.
+        """
+        fr, to = self.span(node, relation)
+        return self.neighbors[fr:to]
+
+    def relations_of(self, node):
+        """
+        :return: The relation of each edge of the given node, in sorted order.
+        """
+        fr, to = self.span(node)
+        return self.relations[fr:to]
+
+    def edges_of(self, node, relation=None):
+        """
+        :return: The indices (in the triples) of the edges of the given node, over all edges or only those with the given
+            relation.
+        """
+        fr, to = self.span(node, relation)
+        return self.edges[fr:to]
+
+    def __getstate__(self):
+        # -- memory-mapped arrays are sent to other processes (like DataLoader workers) by file name, not by value
+        return {k: ('mmap', a.filename) if isinstance(a, np.memmap) and a.filename is not None else a
+                for k, a in self.arrays().items()}
+
+    def __setstate__(self, state):
+        arrays = {k: np.load(a[1], mmap_mode='c') if type(a) == tuple else a for k, a in state.items()}
+        self.__init__(**arrays)
+
+    def tensors(self):
+        """
+        :return: The pointers, relations, neighbors and edges as pytorch tensors, sharing memory with the arrays.
+        """
+        return tuple(torch.from_numpy(np.asarray(a)) for a in (self.pointers, self.relations, self.neighbors, self.edges))
+
+    def arrays(self):
+        """
+        :return: A dict of the arrays that make up this index.
+        """
+        return {'pointers': self.pointers, 'relations': self.relations, 'neighbors': self.neighbors, 'edges': self.edges}
+
+    @staticmethod
+    def from_arrays(arrays):
+        return CSR(arrays['pointers'], arrays['relations'], arrays['neighbors'], arrays['edges'])
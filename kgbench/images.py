@@ -0,0 +1,284 @@
+import base64, io, os, threading, warnings
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+"""
+Lazy access to the images stored in a dataset as base64-encoded literals.
+"""
+
+class LRUCache:
+    """
+    A thread-safe least-recently-used cache of decoded images, bounded by the (approximate) number of bytes taken up by
+    the image data.
+    """
+
+    def __init__(self, budget):
+        """
+        :param budget: The maximum number of bytes of image data to keep. If 0, nothing is cached.
+        """
+        self.budget = budget
+        self.used = 0
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            img = self.images.get(key)
+            if img is not None:
+                self.images.move_to_end(key)
+
+            return img
+
+    def put(self, key, img):
+        size = nbytes(img)
+        if size > self.budget:
+            return
+
+        with self.lock:
+            if key in self.images:
+                return
+
+            self.images[key] = img
+            self.used += size
+
+            while self.used > self.budget:
+                _, old = self.images.popitem(last=False)
+                self.used -= nbytes(old)
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.used = 0
+
+    def __getstate__(self):
+        # -- cached images are not sent along to other processes
+        return {'budget': self.budget}
+
+    def __setstate__(self, state):
+        self.__init__(state['budget'])
+
+def nbytes(img):
+    """
+    :return: The number of bytes taken up by the pixel data of a PIL image.
+    """
+    return img.size[0] * img.size[1] * len(img.getbands())
+
+def decode(raw : bytes):
+    """
+    Decodes a base64-encoded image.
+
+    :param raw: The base64 string, as bytes.
+    :return: A PIL image, or None if the image could not be decoded.
+    """
+    try:
+        img = Image.open(io.BytesIO(base64.urlsafe_b64decode(raw)))
+        img.load()
+    except Exception:
+        return None
+
+    return img
+
+MODES = ['1', 'L', 'P', 'RGB', 'RGBA', 'CMYK', 'YCbCr', 'LA', 'PA', 'I', 'F', 'I;16', 'other']
+""" The image modes (as used by PIL) recorded in the image index. """
+
+FORMATS = ['JPEG', 'PNG', 'GIF', 'WEBP', 'BMP', 'TIFF', 'other']
+""" The image formats recorded in the image index. """
+
+PREFIX = 2**12
+
+def header(raw : bytes):
+    """
+    Reads the size, mode and format of a base64-encoded image from its header, without decoding the pixel data.
+
+    Only the first few kilobytes of the string are decoded. If the header doesn't fit (for instance because of a large
+    block of EXIF data in a JPEG), progressively more of the string is decoded.
+
+    :param raw: The base64 string, as bytes.
+    :return: A tuple (width, height, mode, format), where mode and format are indices into `MODES` and `FORMATS`, or
+        None if the image can't be read.
+    """
+    length = PREFIX
+    while True:
+        complete = length >= len(raw)
+        try:
+            img = Image.open(io.BytesIO(base64.urlsafe_b64decode(raw if complete else raw[:length])))
+            return img.size[0], img.size[1], code(MODES, img.mode), code(FORMATS, img.format)
+        except Exception:
+            if complete:
+                return None
+
+        length *= 16
+
+def code(values, value):
+    return values.index(value) if value in values else len(values) - 1
+
+def headers(raws):
+    """
+    :param raws: A list of base64 strings, as bytes.
+    :return: An (n, 4) integer array with the results of `header()` for each string, with a row of -1s for the images
+        that can't be read.
+    """
+    result = np.full((len(raws), 4), -1, dtype=np.int64)
+    for i, raw in enumerate(raws):
+        h = header(raw)
+        if h is not None:
+            result[i] = h
+
+    return result
+
+CROPS = ['center', 'pad', 'stretch']
+
+def preprocess(img, size=224, resize=256, crop='center'):
+    """
+    Scales and crops a PIL image to a fixed size RGB image.
+
+    :param size: The height and width of the result.
+    :param resize: For the 'center' policy, the length the shorter side is scaled to before cropping.
+    :param crop: How to deal with the aspect ratio:
+     * 'center': scale the shorter side to `resize` and take the central `size` by `size` crop. This is the same
+       as torchvision's `Resize(resize)` followed by `CenterCrop(size)`.
+     * 'pad': scale the longer side to `size`, and pad the shorter side with black.
+     * 'stretch': scale both sides to `size`, ignoring the aspect ratio.
+    :return: A uint8 numpy array of shape (3, size, size).
+    """
+    img = img.convert('RGB')
+    w, h = img.size
+
+    if crop == 'center':
+        # -- sizes and offsets computed as in torchvision
+        if w <= h:
+            img = img.resize((resize, int(resize * h / w)), Image.BILINEAR)
+        else:
+            img = img.resize((int(resize * w / h), resize), Image.BILINEAR)
+
+        top, left = int(round((img.height - size) / 2.0)), int(round((img.width - size) / 2.0))
+        img = img.crop((left, top, left + size, top + size))
+
+    elif crop == 'pad':
+        scale = size / max(w, h)
+        img = img.resize((max(1, round(w * scale)), max(1, round(h * scale))), Image.BILINEAR)
+
+        canvas = Image.new('RGB', (size, size))
+        canvas.paste(img, ((size - img.width) // 2, (size - img.height) // 2))
+        img = canvas
+
+    elif crop == 'stretch':
+        img = img.resize((size, size), Image.BILINEAR)
+
+    else:
+        raise Exception(f'Crop policy {crop} not recognized. Should be one of {CROPS}.')
+
+    return np.asarray(img).transpose(2, 0, 1)
+
+class Images(torch.utils.data.Dataset):
+    """
+    A lazy, indexable view of the images of one datatype in a dataset, in order of their local index.
+
+    Images are only decoded when they are accessed. The most recently used decoded images are kept in a cache with a
+    bounded size in bytes, which is shared by all views sliced from the same view.
+
+    Indexing with an integer returns a PIL image (or the result of `transform` applied to it). Indexing with a slice
+    returns a new view over part of the images, and indexing with a sequence of integers returns a list.
+
+    This is a torch Dataset, so it can be passed directly to a DataLoader. Each worker process starts with its own, empty
+    cache.
+    """
+
+    def __init__(self, table, indices, cache=512 * 2**20, transform=None):
+        """
+        :param table: The NodeTable containing the images.
+        :param indices: The global indices of the images, in order of local index.
+        :param cache: The maximum number of bytes of decoded image data to keep in memory, or an existing LRUCache.
+        :param transform: A function applied to each PIL image when it is returned, for instance a torchvision
+            transform.
+        """
+        self.table = table
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.cache = cache if isinstance(cache, LRUCache) else LRUCache(cache)
+        self.transform = transform
+
+    def __len__(self):
+        return self.indices.shape[0]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return Images(self.table, self.indices[i], self.cache, self.transform)
+
+        if not np.isscalar(i) and not (hasattr(i, 'ndim') and i.ndim == 0):
+            return self.batch(i)
+
+        img = self.image(int(i))
+        return img if self.transform is None else self.transform(img)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def batch(self, indices):
+        """
+        :param indices: A sequence of local indices.
+        :return: A list of the corresponding images.
+        """
+        return [self[i] for i in np.asarray(indices).tolist()]
+
+    def info(self, workers=None):
+        """
+        Reads the width, height, mode and format of each image from its header (see `header()`), without decoding
+        the pixel data.
+
+        :param workers: Number of processes to read the headers with. Defaults to the number of CPUs.
+        :return: An (n, 4) integer array of (width, height, mode, format) rows. Mode and format are indices into
+            `MODES` and `FORMATS`. Images that can't be read get a row of -1s.
+        """
+        workers = os.cpu_count() if workers is None else workers
+        raws = [self.table.raw(g) for g in self.indices.tolist()]
+
+        if workers <= 1 or len(raws) < 4096:
+            return headers(raws)
+
+        # -- only send the start of each image to the workers, and retry those that need more in this process
+        chunks = [[raw[:PREFIX] for raw in raws[fr:fr+4096]] for fr in range(0, len(raws), 4096)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            result = np.concatenate(list(pool.map(headers, chunks)), axis=0)
+
+        for i in np.flatnonzero(result[:, 0] < 0).tolist():
+            if len(raws[i]) > PREFIX:
+                result[i] = headers([raws[i]])[0]
+
+        return result
+
+    def sizes(self):
+        """
+        Reads the size of each image from its header, without decoding the pixel data. Images that cannot be read
+        get size (1, 1), the size of the image that replaces them.
+
+        :return: An (n, 2) integer array of (width, height) pairs.
+        """
+        sizes = self.info()[:, :2]
+        sizes[sizes[:, 0] < 0] = 1
+
+        return sizes
+
+    def image(self, i):
+        """
+        Returns the i-th image as a PIL image, decoding it if it is not in the cache.
+
+        Images that cannot be decoded are replaced by a 1x1 black image, with a warning.
+        """
+        g = int(self.indices[i])
+
+        img = self.cache.get(g)
+        if img is None:
+            img = decode(self.table.raw(g))
+
+            if img is None:
+                warnings.warn(f'Image {i} (node {g}) couldn\'t be parsed. It has been replaced by a black image.')
+                img = Image.new('RGB', (1, 1))
+
+            self.cache.put(g, img)
+
+        return img
@@ -0,0 +1,449 @@
+import numpy as np
+
+"""
+Compact storage for the string representations of the nodes in a graph.
+"""
+
+class NodeTable:
+    """
+    A read-only table mapping node indices to (label, annotation) pairs.
+
+    Instead of one Python string per node, all labels are stored as UTF-8 in a single contiguous byte buffer, with an
+    offsets array marking where each label starts and ends. The annotations are stored as a small integer code per node,
+    indexing a list of the distinct annotations. The pairs are only decoded to Python objects when they are accessed.
+
+    Indexing with an integer returns the `(label, annotation)` pair, so that the table can be used as a drop-in
+    replacement for a list of pairs. Indexing with a slice or an array of indices returns a new table containing only the
+    selected nodes.
+    """
+
+    def __init__(self, buffer, offsets, codes, annotations):
+        """
+        :param buffer: A uint8 array containing the UTF-8 encoded labels of all nodes, concatenated.
+        :param offsets: An int64 array of length n+1, so that the label of node i is `buffer[offsets[i]:offsets[i+1]]`
+        :param codes: An integer array of length n, containing the annotation code of each node.
+        :param annotations: A list of strings so that `annotations[codes[i]]` is the annotation of node i.
+        """
+
+        assert offsets.shape[0] == codes.shape[0] + 1
+
+        self.buffer = buffer
+        self.offsets = offsets
+        self.codes = codes
+        self.annotations = list(annotations)
+
+    @staticmethod
+    def from_pairs(pairs, annotations=None):
+        """
+        Creates a table from a sequence of (label, annotation) pairs.
+
+        :param pairs:
+        :param annotations: The list of distinct annotations, which determines the annotation codes. If None, the
+            annotations are coded in order of first appearance.
+        :return:
+        """
+        labels = [label for label, _ in pairs]
+        dtypes = [dt for _, dt in pairs]
+
+        return NodeTable.from_columns(labels, dtypes, annotations)
+
+    @staticmethod
+    def from_columns(labels, dtypes, annotations=None):
+        """
+        Creates a table from a sequence of labels and a sequence of annotations of the same length.
+
+        :param labels:
+        :param dtypes:
+        :param annotations: The list of distinct annotations, which determines the annotation codes. If None, the
+            annotations are coded in order of first appearance.
+        :return:
+        """
+        assert len(labels) == len(dtypes)
+
+        if annotations is None:
+            annotations = list(dict.fromkeys(dtypes))
+        a2c = {a: c for c, a in enumerate(annotations)}
+
+        assert len(annotations) < 2**15, f'Too many distinct annotations ({len(annotations)}).'
+
+        encoded = [label.encode('utf-8') for label in labels]
+
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter((len(e) for e in encoded), dtype=np.int64, count=len(encoded)), out=offsets[1:])
+
+        buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        codes = np.fromiter((a2c[dt] for dt in dtypes), dtype=np.int16, count=len(dtypes))
+
+        return NodeTable(buffer, offsets, codes, annotations)
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.take(np.arange(len(self))[i])
+
+        if not np.isscalar(i) and not (hasattr(i, 'ndim') and i.ndim == 0):
+            return self.take(i)
+
+        return self.label(i), self.annotation(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def raw(self, i):
+        """
+        :param i:
+        :return: The label of node i as UTF-8 encoded bytes.
+        """
+        return self.buffer[self.offsets[i]:self.offsets[i+1]].tobytes()
+
+    def label(self, i):
+        """
+        :param i:
+        :return: The label of node i.
+        """
+        return self.raw(i).decode('utf-8')
+
+    def labels(self, indices=None):
+        """
+        :param indices: A sequence of node indices. If None, all nodes are returned.
+        :return: A list of the labels of the given nodes.
+        """
+        if indices is None:
+            indices = range(len(self))
+
+        return [self.label(i) for i in np.asarray(indices).tolist()]
+
+    def annotation(self, i):
+        """
+        :param i:
+        :return: The annotation of node i.
+        """
+        return self.annotations[self.codes[i]]
+
+    def take(self, indices):
+        """
+        Returns a new table containing only the given nodes, in the given order.
+
+        :param indices: A sequence of node indices.
+        :return:
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+
+        starts, ends = self.offsets[indices], self.offsets[indices + 1]
+
+        offsets = np.zeros(indices.shape[0] + 1, dtype=np.int64)
+        np.cumsum(ends - starts, out=offsets[1:])
+
+        buffer = np.empty(offsets[-1], dtype=np.uint8)
+
+        # Copy runs of consecutive nodes in one go
+        breaks = np.flatnonzero(indices[1:] != indices[:-1] + 1) + 1
+        runs = np.concatenate([[0], breaks, [indices.shape[0]]]) if indices.shape[0] > 0 else []
+
+        for fr, to in zip(runs[:-1], runs[1:]):
+            buffer[offsets[fr]:offsets[to]] = self.buffer[starts[fr]:ends[to-1]]
+
+        return NodeTable(buffer, offsets, self.codes[indices], self.annotations)
+
+    def arrays(self):
+        """
+        :return: The arrays backing this table as a dict, for storage in the binary cache. See `from_arrays()`.
+        """
+        return {
+            'buffer': self.buffer,
+            'offsets': self.offsets,
+            'codes': self.codes,
+            'annotations': np.asarray(self.annotations, dtype=str)
+        }
+
+    @staticmethod
+    def from_arrays(arrays):
+        """
+        Recreates a table from the dict returned by `arrays()`.
+        """
+        return NodeTable(arrays['buffer'], arrays['offsets'], arrays['codes'], [str(a) for a in arrays['annotations']])
+
+SEPARATOR = b'\x00'
+
+def encode_key(pair):
+    """
+    Encodes a (label, annotation) pair as a single byte string. Since the separator is the smallest possible byte, the
+    byte strings sort in the same order as the pairs.
+    """
+    label, annotation = pair
+    return label.encode('utf-8') + SEPARATOR + annotation.encode('utf-8')
+
+def lcp(a : bytes, b : bytes):
+    """
+    :return: The length of the longest common prefix of a and b.
+    """
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return lo
+
+class FrontCodedDict:
+    """
+    A compressed, read-only dictionary from (label, annotation) pairs to node indices.
+
+    The keys are stored in sorted order, in buckets of `bucket` consecutive keys. The first key of each bucket is stored
+    in full, and every following key only as the length of the prefix it shares with its predecessor, plus the remaining
+    suffix. Since node labels are sorted and share long prefixes (IRIs in the same namespace, base64 images with the same
+    header), this takes a fraction of the memory of a dict.
+
+    A single lookup is a binary search over the buckets followed by decoding one bucket. For many keys at once, use
+    `lookup()`, which locates the buckets of all keys with one vectorized search.
+
+    If the node indices do not follow the sorted order of the keys, a permutation array maps from the sorted position of
+    each key to its index.
+    """
+
+    PREFIX = 32
+    # -- Number of bytes of the first key of each bucket kept in a fixed-width array for vectorized search
+
+    def __init__(self, buffer, offsets, lcps, prefixes, perm, bucket):
+        """
+        :param buffer: uint8 array containing the stored suffixes of all keys, concatenated.
+        :param offsets: int64 array of length n+1 marking the suffix of each key in the buffer.
+        :param lcps: int32 array with, for each key, the length of the prefix shared with the previous key (0 for the
+            first key in a bucket).
+        :param prefixes: Fixed-width bytes array with the first PREFIX bytes of the first key of each bucket.
+        :param perm: int64 array mapping the sorted position of each key to its node index (-1 for keys that are not in
+            the dictionary), or None if these are the same.
+        :param bucket: Number of keys per bucket.
+        """
+        self.buffer = buffer
+        self.offsets = offsets
+        self.lcps = lcps
+        self.prefixes = prefixes
+        self.perm = perm
+        self.bucket = bucket
+
+        self.size = len(lcps) if perm is None else int((perm >= 0).sum())
+
+    @staticmethod
+    def from_pairs(pairs, bucket=16):
+        """
+        Creates a dictionary mapping each pair to its position in the given sequence.
+
+        :param pairs: A sequence of (label, annotation) pairs. This is most efficient if the pairs are sorted.
+        :param bucket: The number of keys per bucket. Larger buckets compress better, but make lookups slower.
+        :return:
+        """
+        return FrontCodedDict.from_keys([encode_key(pair) for pair in pairs], bucket)
+
+    @staticmethod
+    def from_table(table, bucket=16):
+        """
+        Creates a dictionary mapping the (label, annotation) pairs in a NodeTable to their indices.
+
+        :param table:
+        :param bucket: The number of keys per bucket.
+        :return:
+        """
+        annotations = [SEPARATOR + a.encode('utf-8') for a in table.annotations]
+
+        return FrontCodedDict.from_keys([table.raw(i) + annotations[c] for i, c in enumerate(table.codes)], bucket)
+
+    @staticmethod
+    def from_keys(keys, bucket=16):
+        """
+        Creates a dictionary mapping the given encoded keys to their positions.
+        """
+        n = len(keys)
+
+        perm = None
+        if any(keys[i] > keys[i+1] for i in range(n - 1)):
+            order = sorted(range(n), key=keys.__getitem__)
+            keys = [keys[i] for i in order]
+            perm = np.asarray(order, dtype=np.int64)
+
+        suffixes = []
+        lcps = np.zeros(n, dtype=np.int32)
+        for i, key in enumerate(keys):
+            if i > 0 and keys[i-1] == key:
+                raise Exception(f'Duplicate key {key}.')
+
+            if i % bucket != 0:
+                lcps[i] = lcp(keys[i-1], key)
+
+            suffixes.append(key[lcps[i]:])
+
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.fromiter((len(s) for s in suffixes), dtype=np.int64, count=n), out=offsets[1:])
+
+        buffer = np.frombuffer(b''.join(suffixes), dtype=np.uint8)
+        prefixes = np.asarray([keys[i][:FrontCodedDict.PREFIX] for i in range(0, n, bucket)],
+                              dtype=f'S{FrontCodedDict.PREFIX}')
+
+        return FrontCodedDict(buffer, offsets, lcps, prefixes, perm, bucket)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, pair):
+        index = self.index(encode_key(pair))
+        if index < 0:
+            raise KeyError(pair)
+
+        return index
+
+    def __contains__(self, pair):
+        return self.index(encode_key(pair)) >= 0
+
+    def get(self, pair, default=None):
+        index = self.index(encode_key(pair))
+        return default if index < 0 else index
+
+    def keys(self):
+        """
+        Iterates over all (label, annotation) pairs in the dictionary, in sorted order.
+        """
+        for b in range(len(self.prefixes)):
+            for pos, key in zip(self.positions(b), self.decode(b)):
+                if self.perm is None or self.perm[pos] >= 0:
+                    label, annotation = key.split(SEPARATOR, 1)
+                    yield label.decode('utf-8'), annotation.decode('utf-8')
+
+    def index(self, key : bytes):
+        """
+        :param key: An encoded key (see `encode_key()`).
+        :return: The index of the key, or -1 if it is not in the dictionary.
+        """
+        b = self.find_bucket(key, 0, len(self.prefixes) - 1)
+
+        return self.search_bucket(b, key)
+
+    def lookup(self, pairs):
+        """
+        Looks up many (label, annotation) pairs at once.
+
+        The buckets containing the keys are located with a single vectorized search on the key prefixes, and each
+        bucket is decoded only once, no matter how many of the keys it contains.
+
+        :param pairs: A sequence of (label, annotation) pairs.
+        :return: An int64 array containing the index of each pair, or -1 for pairs that are not in the dictionary.
+        """
+        keys = [encode_key(pair) for pair in pairs]
+        result = np.full(len(keys), -1, dtype=np.int64)
+        if len(keys) == 0 or len(self.prefixes) == 0:
+            return result
+
+        prefixes = np.asarray([key[:self.PREFIX] for key in keys], dtype=self.prefixes.dtype)
+
+        # Buckets whose first key has a smaller prefix precede the key, those with a larger prefix follow it. Only
+        # buckets with an identical prefix need to be compared in full.
+        left  = np.searchsorted(self.prefixes, prefixes, side='left')
+        right = np.searchsorted(self.prefixes, prefixes, side='right')
+
+        buckets = np.maximum(left - 1, 0)
+        for i in np.flatnonzero(right > left):
+            buckets[i] = self.find_bucket(keys[i], buckets[i], right[i] - 1)
+
+        order = np.argsort(buckets, kind='stable')
+        bounds = np.flatnonzero(np.diff(buckets[order])) + 1
+        for group in np.split(order, bounds):
+            b = buckets[group[0]]
+            k2i = {key: pos for pos, key in zip(self.positions(b), self.decode(b))}
+
+            for i in group:
+                pos = k2i.get(keys[i])
+                if pos is not None:
+                    result[i] = pos if self.perm is None else self.perm[pos]
+
+        return result
+
+    def remap(self, o2n):
+        """
+        Returns a dictionary for a reordered or reduced set of nodes, sharing the stored keys with this one.
+
+        :param o2n: An integer array mapping each old node index to a new one, or to -1 if the node was removed.
+        :return:
+        """
+        o2n = np.asarray(o2n, dtype=np.int64)
+        perm = o2n if self.perm is None else np.where(self.perm >= 0, o2n[self.perm], -1)
+
+        return FrontCodedDict(self.buffer, self.offsets, self.lcps, self.prefixes, perm, self.bucket)
+
+    def positions(self, b):
+        """
+        :return: The range of sorted positions of the keys in bucket b.
+        """
+        return range(b * self.bucket, min((b + 1) * self.bucket, len(self.lcps)))
+
+    def first(self, b):
+        """
+        :return: The first key of bucket b.
+        """
+        pos = b * self.bucket
+        return self.buffer[self.offsets[pos]:self.offsets[pos+1]].tobytes()
+
+    def decode(self, b):
+        """
+        :return: A list of all keys in bucket b.
+        """
+        keys, key = [], b''
+        for pos in self.positions(b):
+            key = key[:self.lcps[pos]] + self.buffer[self.offsets[pos]:self.offsets[pos+1]].tobytes()
+            keys.append(key)
+
+        return keys
+
+    def find_bucket(self, key, lo, hi):
+        """
+        Binary search for the last bucket in [lo, hi] whose first key is smaller than or equal to the given key.
+        """
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.first(mid) <= key:
+                lo = mid
+            else:
+                hi = mid - 1
+
+        return lo
+
+    def search_bucket(self, b, key):
+        """
+        :return: The index of the given key if it is in bucket b, -1 otherwise.
+        """
+        if b < 0:
+            return -1
+
+        for pos, candidate in zip(self.positions(b), self.decode(b)):
+            if candidate == key:
+                return pos if self.perm is None else int(self.perm[pos])
+            if candidate > key:
+                break
+
+        return -1
+
+    def arrays(self):
+        """
+        :return: The arrays backing this dictionary as a dict, for storage in the binary cache. See `from_arrays()`.
+        """
+        return {
+            'buffer': self.buffer,
+            'offsets': self.offsets,
+            'lcps': self.lcps,
+            'prefixes': self.prefixes,
+            'perm': np.zeros(0, dtype=np.int64) if self.perm is None else self.perm,
+            'bucket': np.asarray([self.bucket])
+        }
+
+    @staticmethod
+    def from_arrays(arrays):
+        """
+        Recreates a dictionary from the dict returned by `arrays()`.
+        """
+        perm = arrays['perm'] if arrays['perm'].shape[0] > 0 else None
+
+        return FrontCodedDict(arrays['buffer'], arrays['offsets'], arrays['lcps'], arrays['prefixes'], perm,
+                              int(arrays['bucket'][0]))
@@ -0,0 +1,180 @@
+import numpy as np
+import torch
+
+"""
+Neighborhood sampling for mini-batch training of message passing models.
+"""
+
+class Block:
+    """
+    The sampled edges of one layer of a message passing model.
+
+    Messages flow from the first `num_src` nodes of the sample to the first `num_dst` nodes. Since the destination nodes
+    are a prefix of the source nodes, each destination node can also be given a self-loop.
+    """
+
+    def __init__(self, edges, num_src, num_dst):
+        """
+        :param edges: A (k, 3) long tensor of (source, relation, destination) triples, in local indices.
+        :param num_src: Number of source nodes.
+        :param num_dst: Number of destination nodes.
+        """
+        self.edges = edges
+        self.num_src = num_src
+        self.num_dst = num_dst
+
+    def __repr__(self):
+        return f'Block({self.edges.size(0)} edges, {self.num_src} -> {self.num_dst} nodes)'
+
+class Sample:
+    """
+    A sampled neighborhood of a batch of target nodes.
+    """
+
+    def __init__(self, nodes, blocks, num_targets, labels=None):
+        """
+        :param nodes: The global indices of all nodes in the sample. The local index of a node is its position here, and
+            the targets come first.
+        :param blocks: One Block per layer, from the input layer to the output layer.
+        :param num_targets: Number of target nodes.
+        :param labels: The classes of the targets, if these were given.
+        """
+        self.nodes = nodes
+        self.blocks = blocks
+        self.num_targets = num_targets
+        self.labels = labels
+
+    @property
+    def targets(self):
+        return self.nodes[:self.num_targets]
+
+    def __repr__(self):
+        return f'Sample({self.num_targets} targets, {self.nodes.size(0)} nodes, {self.blocks})'
+
+class NeighborSampler:
+    """
+    Samples the multi-hop neighborhood of a batch of target nodes, with a limit on the number of neighbors per node for
+    each hop.
+
+    Both directions of each edge are used. Following the convention in the RGCN baselines, a node receives messages
+    from the objects of its outgoing edges with the relation of the edge (0 to r-1), and from the subjects of its incoming
+    edges with the inverse relation (r to 2r-1).
+
+    At each hop, the neighbors of all nodes in the sample so far are sampled, so that the nodes of each layer are a
+    prefix of the nodes of the layer below it. The first hop gives the edges of the last layer.
+
+    The sampler can be passed as the `collate_fn` of a pytorch DataLoader, over the target nodes or over the rows of
+    `data.training`:
+
+    ```
+    sampler = kg.NeighborSampler(data, fanouts=[10, 10])
+    loader = DataLoader(data.training, batch_size=256, shuffle=True, collate_fn=sampler, num_workers=4)
+    for sample in loader:
+        ...
+    ```
+
+    Random numbers are drawn from pytorch's random number generator, which the DataLoader seeds differently in each
+    worker.
+    """
+
+    def __init__(self, data, fanouts):
+        """
+        :param data: A Data object. The adjacency indices (`data.csr()`) are built if they don't exist yet.
+        :param fanouts: The maximum number of neighbors sampled per node, for each hop, starting with the hop from the
+            targets. None or -1 means all neighbors.
+        """
+        self.out, self.inc = data.csr('out'), data.csr('in')
+        self.num_relations = data.num_relations
+        self.fanouts = [-1 if f is None else f for f in fanouts]
+
+    def __call__(self, batch):
+        """
+        :param batch: A sequence of target node indices, or of (node, class) rows.
+        :return: A Sample.
+        """
+        batch = np.stack([np.asarray(item) for item in batch])
+
+        if batch.ndim == 2:
+            return self.sample(batch[:, 0], labels=batch[:, 1])
+
+        return self.sample(batch)
+
+    def sample(self, targets, labels=None, rng=None):
+        """
+        :param targets: An array of distinct target node indices.
+        :param labels: The classes of the targets, if available.
+        :param rng: A numpy random generator. If None, one is seeded from pytorch's random number generator.
+        :return: A Sample.
+        """
+        rng = np.random.default_rng(torch.randint(2**62, ()).item()) if rng is None else rng
+
+        nodes = np.asarray(targets, dtype=np.int64)
+        assert np.unique(nodes).shape[0] == nodes.shape[0], 'Target nodes should be distinct.'
+
+        blocks = []
+        for fanout in self.fanouts:
+            num_dst = nodes.shape[0]
+
+            dst, rel, src = self.neighbors(nodes, fanout, rng)
+
+            # -- add the new nodes, in order of first appearance
+            nodes, local = extend(nodes, src)
+            blocks.append(Block(torch.from_numpy(np.stack([local, rel, dst], axis=1)), nodes.shape[0], num_dst))
+
+        return Sample(torch.from_numpy(nodes), blocks[::-1], len(targets),
+                      labels=None if labels is None else torch.as_tensor(labels))
+
+    def neighbors(self, nodes, fanout, rng):
+        """
+        Samples up to `fanout` edges for each of the given nodes. Nodes with at most `fanout` edges keep all of them.
+        For the others, `fanout` edges are drawn with replacement, and duplicates are removed.
+
+        :return: Three arrays: for each sampled edge, the local index of the node it was sampled for, the relation
+            (inverse relations for incoming edges) and the global index of the neighbor.
+        """
+        outdeg = self.out.pointers[nodes + 1] - self.out.pointers[nodes]
+        indeg  = self.inc.pointers[nodes + 1] - self.inc.pointers[nodes]
+        deg = outdeg + indeg
+
+        # -- local node index and position among the node's edges, for every sampled edge
+        full = deg if fanout < 0 else np.where(deg <= fanout, deg, 0)
+        node = np.repeat(np.arange(nodes.shape[0]), full)
+        pos = np.arange(node.shape[0]) - np.repeat(np.cumsum(full) - full, full)
+
+        over = np.flatnonzero(deg > fanout) if fanout >= 0 else []
+        if len(over) > 0:
+            snode = np.repeat(over, fanout)
+            spos = np.floor(rng.random(snode.shape[0]) * deg[snode]).astype(np.int64)
+
+            # -- remove duplicates (this also sorts by node)
+            m = int(deg.max())
+            key = np.unique(snode * m + spos)
+            node, pos = np.concatenate([node, key // m]), np.concatenate([pos, key % m])
+
+        isout = pos < outdeg[node]
+
+        out = self.out.pointers[nodes[node[isout]]] + pos[isout]
+        inc = self.inc.pointers[nodes[node[~isout]]] + pos[~isout] - outdeg[node[~isout]]
+
+        dst = np.concatenate([node[isout], node[~isout]])
+        rel = np.concatenate([self.out.relations[out], self.inc.relations[inc] + self.num_relations])
+        src = np.concatenate([self.out.neighbors[out], self.inc.neighbors[inc]])
+
+        return dst, rel, src
+
+def extend(nodes, new):
+    """
+    Appends the nodes in `new` that aren't in `nodes` yet, in order of first appearance.
+
+    :param nodes: An array of distinct node indices.
+    :param new: An array of node indices.
+    :return: The extended array, and the positions of the elements of `new` in it.
+    """
+    joined = np.concatenate([nodes, new])
+    unique, first, inverse = np.unique(joined, return_index=True, return_inverse=True)
+
+    order = np.argsort(first, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.shape[0])
+
+    return unique[order], rank[inverse[nodes.shape[0]:]]
@@ -1,6 +1,9 @@
 import os
 import torch
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import rdflib as rdf
 
 import time
@@ -77,74 +80,273 @@ def load_rdf(rdf_file, name='', format='nt', store_file='./cache'):
 
     return graph
 
-def to_tvbatches(images, batch_size=16,  min_size=0, dtype=None, prep=tv.transforms.ToTensor()):
+def to_tvbatches(images, batch_size=16,  min_size=0, dtype=None, prep=tv.transforms.ToTensor(), workers=0, prefetch=2,
+                 reuse=False, order=None):
     """
     Returns a generator over torch batches of tensors, using torchvision transforms to translate from
     PIL images to tensors.
 
+    If `workers` is positive, upcoming batches are decoded, padded and transformed by a pool of threads while the
+    current batch is being consumed. The batches are returned in the same order either way. PIL and torch release
+    the GIL for the expensive parts (decoding, resizing, conversion), so threads run these in parallel.
+
     :param images:
-    :param torch:
+    :param workers: Number of threads preparing batches. If 0, each batch is prepared when it is requested.
+    :param prefetch: The maximum number of batches prepared ahead, per worker.
+    :param reuse: Reuse the memory of earlier batches for new batches of the same shape. This means a batch is only
+        valid until the next batch is requested: copy it if it should be kept.
+    :param order: If given, the images are batched in this order (see `size_order()`) rather than in the order of
+        `images`.
     :return:
     """
 
-    batches = []
-    for fr in range(0, len(images), batch_size):
-        batch = images[fr:fr+batch_size]
-
-        yield to_tvbatch(batch, min_size=min_size, dtype=dtype, prep=prep)
-
-def to_tensorbatches(images, batch_size=16, use_torch=False, min_size=0, dtype=None):
+    starts = range(0, len(images), batch_size)
+    images = images if order is None else Reordered(images, order)
+
+    # -- with reuse, batch k is written into buffer k % len(buffers). The buffers of batches that may still be being
+    #    prepared or consumed are never reused.
+    buffers = [None] * (max(workers, 0) * prefetch + 1)
+
+    if workers <= 0:
+        for fr in starts:
+            buffers[0] = to_tvbatch(images[fr:fr+batch_size], min_size=min_size, dtype=dtype, prep=prep,
+                                    out=buffers[0] if reuse else None)
+            yield buffers[0]
+        return
+
+    starts = iter(enumerate(starts))
+    pending = deque()
+
+    def submit():
+        k, fr = next(starts, (None, None))
+        if fr is not None:
+            out = buffers[k % len(buffers)] if reuse else None
+            pending.append((k, pool.submit(to_tvbatch, images[fr:fr+batch_size], min_size=min_size, dtype=dtype,
+                                           prep=prep, out=out)))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for _ in range(workers * prefetch):
+                submit()
+
+            while len(pending) > 0:
+                k, future = pending.popleft()
+                batch = buffers[k % len(buffers)] = future.result()
+                submit()
+
+                yield batch
+        finally:
+            # -- if the generator is closed early, don't prepare any more batches
+            for _, future in pending:
+                future.cancel()
+
+def to_tensorbatches(images, batch_size=16, use_torch=False, min_size=0, dtype=None, reuse=False, order=None):
     """
     Returns a generator over batches of tensors.
 
     :param images:
     :param torch:
+    :param reuse: Reuse the memory of the previous batch if the next batch has the same shape. This means a batch is
+        only valid until the next batch is requested: copy it if it should be kept.
+    :param order: If given, the images are batched in this order (see `size_order()`) rather than in the order of
+        `images`.
     :return:
     """
 
-    batches = []
+    images = images if order is None else Reordered(images, order)
+
+    batch = None
     for fr in range(0, len(images), batch_size):
-        batch = images[fr:fr+batch_size]
+        batch = to_tensorbatch(images[fr:fr+batch_size], use_torch, min_size, dtype, out=batch if reuse else None)
+
+        yield batch
+
+def size_order(images, batch_size=16, window=4):
+    """
+    Returns an order of the images in which images of similar size are next to each other, so that batches taken in
+    this order need little padding.
+
+    The images are sorted by height, and then, within each run of `window` consecutive batches, by width.
+
+    To get results in the original order, put the results back with `result[order] = ...`, or index them with
+    `np.argsort(order)`.
+
+    :param images: A sequence of PIL images, an `Images` object, or an (n, 2) array of (width, height) pairs.
+    :param batch_size: The batch size that will be used.
+    :param window: The number of batches over which images are sorted by width.
+    :return: An integer array containing a permutation of the indices of the images.
+    """
+    if hasattr(images, 'sizes'):
+        sizes = images.sizes()
+    elif len(images) > 0 and isinstance(images[0], PIL.Image.Image):
+        sizes = np.asarray([img.size for img in images])
+    else:
+        sizes = np.asarray(images).reshape(-1, 2)
+
+    order = np.argsort(sizes[:, 1], kind='stable')
+
+    chunk = batch_size * window
+    for fr in range(0, len(order), chunk):
+        part = order[fr:fr+chunk]
+        order[fr:fr+chunk] = part[np.argsort(sizes[part, 0], kind='stable')]
+
+    return order
+
+def padding(sizes, batch_size=16, min_size=0, order=None):
+    """
+    Computes the number of pixels that batching adds as padding.
+
+    :param sizes: An (n, 2) array of (width, height) pairs.
+    :param order: The order in which the images are batched. If None, the images are batched in order.
+    :return: The number of pixels in all batches, and the number of pixels in all images.
+    """
+    sizes = np.asarray(sizes)
+    if order is not None:
+        sizes = sizes[order]
+
+    batched = 0
+    for fr in range(0, len(sizes), batch_size):
+        batch = sizes[fr:fr+batch_size]
+        batched += len(batch) * max(batch[:, 0].max(), min_size) * max(batch[:, 1].max(), min_size)
+
+    return int(batched), int((sizes[:, 0] * sizes[:, 1]).sum())
+
+class Reordered:
+    """
+    A view of a sequence in a different order. Slices are resolved to lists of elements (or to batches, for sequences
+    with a `batch()` method, like `Images`).
+    """
+
+    def __init__(self, sequence, order):
+        self.sequence = sequence
+        self.order = np.asarray(order)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            indices = self.order[i]
+            if hasattr(self.sequence, 'batch'):
+                return self.sequence.batch(indices)
+            return [self.sequence[j] for j in indices.tolist()]
+
+        return self.sequence[int(self.order[i])]
 
-        yield to_tensorbatch(batch, use_torch, min_size, dtype)
+def to_tensorbatch(images, use_torch=False, min_size=0, dtype=None, out=None):
+    """
+    Stacks a list of PIL images into a single (b, c, h, w) batch. Smaller images are padded with black to the size of
+    the largest image, and centered.
 
-def to_tensorbatch(images, use_torch=False, min_size=0, dtype=None):
+    :param images:
+    :param use_torch: Return a pytorch tensor instead of a numpy array.
+    :param min_size: Minimum width and height of the batch.
+    :param dtype: The dtype of the result (numpy or pytorch). Pixel values are scaled to [0, 1] for floating point
+        dtypes, and kept as is for integer dtypes. Defaults to float32.
+    :param out: An earlier batch to write the result into, if it has the right shape and dtype.
+    :return:
+    """
 
     maxw = max(max([img.size[0] for img in images]), min_size)
     maxh = max(max([img.size[1] for img in images]), min_size)
 
-    res = []
-    for img in images:
-        img = pad(img, (maxw, maxh))
-        img = np.array(img)[None, :, :, :].astype(np.double)/255.
-        res.append( img.transpose((0, 3, 1, 2)) ) # bchw dim ordering
+    dtype = np.dtype(np.float32 if dtype is None else numpy_dtype(dtype))
+    shape = (len(images), len(images[0].getbands()), maxh, maxw)
 
-    res = np.concatenate(res, axis=0)
-    res = torch.from_numpy(res) if use_torch else res
-    if dtype is not None:
-        res = res.to(dtype) if use_torch else res.astype(dtype)
-    return res
+    res = buffer(out.numpy() if torch.is_tensor(out) else out, shape, dtype)
+    paste(images, res)
+
+    return torch.from_numpy(res) if use_torch else res # -- from_numpy shares the memory
+
+def to_tvbatch(images, min_size=0, dtype=None, prep=tv.transforms.ToTensor(), out=None):
+    """
+    Stacks a list of PIL images into a single (b, c, h, w) tensor. Smaller images are padded with black to the size of
+    the largest image, and centered, before `prep` is applied.
 
-def to_tvbatch(images, min_size=0, dtype=None, prep=tv.transforms.ToTensor()):
+    :param images:
+    :param min_size: Minimum width and height of the padded images.
+    :param dtype: The dtype of the result. Defaults to that of the output of `prep`.
+    :param prep: A transform from a PIL image to a (c, h, w) tensor.
+    :param out: An earlier batch to write the result into, if it has the right shape and dtype.
+    :return:
+    """
+
+    if type(prep) == tv.transforms.ToTensor:
+        # -- ToTensor only scales the pixels, so we can skip the padded intermediate images
+        return to_tensorbatch(images, use_torch=True, min_size=min_size,
+                              dtype=torch.float32 if dtype is None else dtype, out=out)
 
     maxw = max(max([img.size[0] for img in images]), min_size)
     maxh = max(max([img.size[1] for img in images]), min_size)
 
-    res = []
-    for img in images:
-        img = pad(img, (maxw, maxh))
-        res.append(prep(img)[None, :, :, :])
+    res = None
+    for i, img in enumerate(images):
+        img = prep(pad(img, (maxw, maxh)))
 
-    res = torch.cat(res, dim=0)
-    if dtype is not None:
-        res = res.to(dtype)
+        if res is None:
+            res = buffer(out, (len(images),) + tuple(img.size()), img.dtype if dtype is None else dtype)
+
+        res[i].copy_(img)
 
     return res
 
+def numpy_dtype(dtype):
+    """
+    :param dtype: A numpy or pytorch dtype.
+    :return: The corresponding numpy dtype.
+    """
+    if isinstance(dtype, torch.dtype):
+        return torch.empty((), dtype=dtype).numpy().dtype
+
+    return np.dtype(dtype)
+
+def buffer(out, shape, dtype):
+    """
+    Returns `out` if it is an array or tensor of the given shape and dtype, and a new, uninitialized array (or tensor,
+    if `dtype` is a pytorch dtype) otherwise.
+    """
+    if out is not None and tuple(out.shape) == tuple(shape) and out.dtype == dtype:
+        return out
+
+    if isinstance(dtype, torch.dtype):
+        return torch.empty(shape, dtype=dtype)
+
+    return np.empty(shape, dtype=dtype)
+
+def paste(images, res):
+    """
+    Writes a list of PIL images into the (b, c, h, w) numpy array `res`, each centered in its slot. Pixel values are
+    scaled to [0, 1] if `res` has a floating point dtype. The padding around smaller images is set to zero, so every
+    element of `res` is written exactly once.
+    """
+    b, c, maxh, maxw = res.shape
+    floating = np.issubdtype(res.dtype, np.floating)
+
+    for i, img in enumerate(images):
+        w, h = img.size
+        top, left = (maxh - h) // 2, (maxw - w) // 2
+
+        res[i, :, :top, :] = 0
+        res[i, :, top+h:, :] = 0
+        res[i, :, top:top+h, :left] = 0
+        res[i, :, top:top+h, left+w:] = 0
+
+        pixels = np.asarray(img).reshape(h, w, -1).transpose(2, 0, 1)
+        slot = res[i, :, top:top+h, left:left+w]
+
+        if floating:
+            np.divide(pixels, res.dtype.type(255), out=slot)
+        else:
+            slot[...] = pixels
+
 def pad(im, desired_size):
 
     dw = desired_size[0] - im.size[0]
     dh = desired_size[1] - im.size[1]
+
+    if dw == 0 and dh == 0:
+        return im
+
     padding = (dw // 2, dh // 2, dw - (dw // 2), dh - (dh // 2))
 
     return ImageOps.expand(im, padding)
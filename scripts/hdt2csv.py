@@ -12,7 +12,8 @@ from rdflib import Graph
 
 import kgbench as kg
 
-
+BATCH = 100_000
+# -- Number of triples for which the nodes are looked up at once
 
 def generate_csv_context(doc):
     entities = set()
@@ -54,7 +55,7 @@ def generate_csv_context(doc):
     df = pd.DataFrame(enumerate(i2r), columns=['index', 'label'])
     df.to_csv('relations.int.csv', index=False, header=True, quoting=csv.QUOTE_NONNUMERIC)
 
-    e2i = {e:i for i, e in enumerate(i2e)}
+    e2i = kg.FrontCodedDict.from_pairs(i2e)
     r2i = {r:i for i, r in enumerate(i2r)}
 
     # Write triples to CSV
@@ -62,15 +63,29 @@ def generate_csv_context(doc):
     triples, c = doc.search_triples('', '', '')
     with gzip.open('triples.int.csv.gz', 'wt') as file:
 
-        for s, p, o in tqdm(triples, total=c):
+        batch = []
+        for triple in tqdm(triples, total=c):
+            batch.append(triple)
 
-            sp = kg.entity_hdt(s)
-            op = kg.entity_hdt(o)
+            if len(batch) >= BATCH:
+                write_triples(file, batch, e2i, r2i)
+                batch = []
 
-            file.write(f'{e2i[sp]}, {r2i[p]}, {e2i[op]}\n')
+        write_triples(file, batch, e2i, r2i)
 
     return (e2i, r2i)
 
+def write_triples(file, batch, e2i, r2i):
+    """
+    Writes a batch of HDT triples as integer triples, looking up all subjects and objects in one go.
+    """
+    subjects = e2i.lookup([kg.entity_hdt(s) for s, _, _ in batch])
+    objects  = e2i.lookup([kg.entity_hdt(o) for _, _, o in batch])
+
+    assert (subjects >= 0).all() and (objects >= 0).all()
+
+    file.write(''.join(f'{si}, {r2i[p]}, {oi}\n' for si, (_, p, _), oi in zip(subjects, batch, objects)))
+
 def generate_csv_splits(splits, e2i, r2i):
     if len(splits) <= 0:
         return
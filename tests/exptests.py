@@ -8,6 +8,7 @@ import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../experiments')))
 
 import rgcn
+import kgbench as kg
 
 class TestExps(unittest.TestCase):
 
@@ -18,7 +19,162 @@ class TestExps(unittest.TestCase):
 
         print(vals / rgcn.sum_sparse(indices.t(), vals, (3, 3), row=False))
 
+    def test_adjacencies(self):
 
+        triples = torch.tensor([[0, 0, 1], [1, 1, 2], [2, 0, 0], [0, 0, 2]])
+        n, r = 3, 2
 
+        adj = rgcn.adjacencies(triples, n, r)
+        ver = torch.sparse_coo_tensor(adj['ver'].t(), adj['vals'], size=((2*r+1) * n, n)).to_dense()
+        hor = torch.sparse_coo_tensor(adj['hor'].t(), adj['vals'], size=(n, (2*r+1) * n)).to_dense()
 
+        # -- the same matrices, stacked differently
+        self.assertTrue(torch.equal(hor, torch.cat(ver.split(n, dim=0), dim=1)))
 
+        # -- rows are normalized, every node has a self-loop
+        sums = ver.sum(dim=1)
+        self.assertTrue(torch.allclose(sums[sums > 0], torch.ones(1)))
+        self.assertTrue(torch.equal(ver[2*r*n:, :], torch.eye(n)))
+
+        self.assertEqual(ver[0, 1].item(), 0.5) # -- node 0 has two outgoing edges with relation 0
+
+    def test_adjacency(self):
+
+        torch.manual_seed(0)
+        n, r = 30, 3
+        triples = torch.stack([torch.randint(n, (60,)), torch.randint(r, (60,)), torch.randint(n, (60,))], dim=1)
+
+        adj = rgcn.adjacencies(triples, n, r)
+        ver = torch.sparse_coo_tensor(adj['ver'].t(), adj['vals'], size=((2*r+1) * n, n)).to_dense()
+        hor = torch.sparse_coo_tensor(adj['hor'].t(), adj['vals'], size=(n, (2*r+1) * n)).to_dense()
+
+        # -- the implicit operator gives the same matrices as adding the inverses and self-loops to the triples
+        operator = kg.Adjacency(triples, n, r)
+        self.assertTrue(torch.equal(ver, operator.explicit().to_dense()))
+        self.assertTrue(torch.equal(hor, operator.explicit(horizontal=True).to_dense()))
+
+        h, w = torch.randn(n, 4), torch.randn((2*r+1) * n, 4)
+        self.assertTrue(torch.allclose(ver @ h, operator.vertical(h), atol=1e-6))
+        self.assertTrue(torch.allclose(hor @ w, operator.horizontal(w), atol=1e-6))
+
+        weights = torch.randn(2*r+1, 4, 2)
+        expected = torch.bmm((ver @ h).view(2*r+1, n, 4), weights).sum(dim=0)
+        for chunk in [None, 2]:
+            self.assertTrue(torch.allclose(expected, operator.stacked(h, weights, chunk=chunk), atol=1e-5))
+
+    def test_propagate(self):
+
+        torch.manual_seed(0)
+        n, r = 30, 3
+        triples = torch.stack([torch.randint(n, (60,)), torch.randint(r, (60,)), torch.randint(n, (60,))], dim=1)
+
+        operator = kg.Adjacency(triples, n, r)
+        ver = operator.explicit().to_dense().view(2*r+1, n, n)
+
+        # -- the second hop propagates the mean over the relations each node has
+        x = torch.randn(n, 4)
+        first = ver @ x
+        counts = (ver.sum(dim=2) > 0).sum(dim=0)
+        second = ver @ (first.sum(dim=0) / counts[:, None])
+
+        nodes = torch.tensor([3, 0, 7])
+        for chunk in [None, 2]:
+            out = operator.propagate(x, nodes, hops=2, chunk=chunk)
+
+            self.assertEqual(out.shape, (3, 2, 2*r+1, 4))
+            self.assertTrue(torch.allclose(torch.from_numpy(out[:, 0]), first[:, nodes].transpose(0, 1), atol=1e-5))
+            self.assertTrue(torch.allclose(torch.from_numpy(out[:, 1]), second[:, nodes].transpose(0, 1), atol=1e-5))
+
+    def test_csr_adjacency(self):
+
+        torch.manual_seed(0)
+        n, r = 50, 3
+        triples = torch.stack([torch.randint(n, (200,)), torch.randint(r, (200,)), torch.randint(n, (200,))], dim=1)
+        operator = kg.Adjacency(triples, n, r)
+
+        h = torch.randn(n, 4, requires_grad=True)
+        weights = torch.randn(2*r+1, 4, 3, requires_grad=True)
+
+        expected = operator.stacked(h, weights)
+        grads = torch.autograd.grad(expected.pow(2).sum(), [h, weights])
+
+        for threads in [1, 3]:
+            csr = kg.CSRAdjacency(operator, threads=threads)
+            for checkpoint in [False, True]:
+                out = csr.stacked(h, weights, checkpoint=checkpoint)
+                self.assertTrue(torch.allclose(expected, out, atol=1e-5))
+
+                for g, e in zip(torch.autograd.grad(out.pow(2).sum(), [h, weights]), grads):
+                    self.assertTrue(torch.allclose(g, e, atol=1e-4))
+
+        # -- the self-loops get the dtype of the normalization values
+        double = kg.Adjacency(triples, n, r, norms=(operator.out_norm.double(), operator.in_norm.double()))
+        csr = kg.CSRAdjacency(double, threads=1)
+        self.assertTrue(all(m.dtype == torch.float64 for m in csr.csr))
+
+        half = kg.Adjacency(triples, n, r, norms=(operator.out_norm.half(), operator.in_norm.half()))
+        self.assertTrue(all(m.dtype == torch.float16 for m in kg.CSRAdjacency(half, threads=1).csr))
+        self.assertTrue(torch.allclose(expected.double(), csr.stacked(h.double(), weights.double()), atol=1e-5))
+
+        model = rgcn.RGCN(triples, n=n, r=r, numcls=3, emb=4)
+        full = model()
+        model.csr = True
+        self.assertTrue(torch.allclose(full, model(), atol=1e-5))
+
+    def test_restrict(self):
+
+        torch.manual_seed(0)
+        n, r = 30, 3
+        triples = torch.stack([torch.randint(n, (60,)), torch.randint(r, (60,)), torch.randint(n, (60,))], dim=1)
+        targets = torch.tensor([4, 0, 17])
+
+        for bases in [None, 2]:
+            model = rgcn.RGCN(triples, n=n, r=r, numcls=3, emb=4, bases=bases)
+
+            self.assertTrue(torch.allclose(model()[targets], model(targets), atol=1e-6))
+            self.assertEqual(model.restricted[2].size(0), (2*r+1) * targets.size(0))
+
+    def test_sparse(self):
+
+        torch.manual_seed(0)
+        n, r = 30, 3
+        triples = torch.stack([torch.randint(n, (60,)), torch.randint(r, (60,)), torch.randint(n, (60,))], dim=1)
+        targets = torch.tensor([4, 0, 17])
+
+        dense = rgcn.RGCN(triples, n=n, r=r, numcls=3, emb=4)
+        model = rgcn.RGCN(triples, n=n, r=r, numcls=3, emb=4, sparse=True)
+        model.load_state_dict(dense.state_dict())
+
+        # -- one weight row per (relation, node) pair with an edge, not per relation and node
+        self.assertLess(model.weights1.size(0), (2*r+1) * n)
+
+        self.assertTrue(torch.allclose(dense(), model(), atol=1e-6))
+        self.assertTrue(torch.allclose(model()[targets], model(targets), atol=1e-6))
+
+        (model(targets).sum() + model.penalty()).backward()
+        self.assertTrue(model.weights1.grad.is_sparse)
+        self.assertEqual(model.norms1().size(0), 2*r+1)
+
+    def test_chunked(self):
+
+        torch.manual_seed(0)
+        n, r = 30, 3
+        triples = torch.stack([torch.randint(n, (60,)), torch.randint(r, (60,)), torch.randint(n, (60,))], dim=1)
+        targets = torch.tensor([4, 0, 17])
+
+        for bases in [None, 2]:
+            model = rgcn.RGCN(triples, n=n, r=r, numcls=3, emb=4, bases=bases)
+            full = model()
+            full.sum().backward()
+            grad = model.bias1.grad.clone()
+
+            for chunk, checkpoint in [(1, False), (3, True), (2*r+1, False), (100, True)]:
+                model.zero_grad()
+                model.chunk, model.checkpoint = chunk, checkpoint
+
+                out = model()
+                self.assertTrue(torch.allclose(full, out, atol=1e-6))
+                self.assertTrue(torch.allclose(full[targets], model(targets), atol=1e-6))
+
+                out.sum().backward()
+                self.assertTrue(torch.allclose(grad, model.bias1.grad, atol=1e-5))
@@ -2,7 +2,9 @@ import unittest
 import torch
 from torch import nn
 
-import sys
+import sys, os, gzip, tempfile, time
+
+import numpy as np
 
 import kgbench as kg
 from kgbench import tic, toc
@@ -80,5 +82,325 @@ class TestLoad(unittest.TestCase):
         for s in strings:
             print(s)
 
+    def test_cache(self):
+
+        with tempfile.TemporaryDirectory() as dir:
+            file = os.path.join(dir, 'triples.int.csv.gz')
+            with gzip.open(file, 'wt') as out:
+                out.write('0, 0, 1\n1, 0, 2\n2, 1, 0\n')
+
+            first = kg.load_triples(file)
+            second = kg.load_triples(file)
+
+            self.assertIsInstance(second, np.memmap)
+            self.assertTrue((first == second).all())
+            self.assertEqual(second.shape, (3, 3))
+
+            # -- changing the source invalidates the cache
+            time.sleep(0.01)
+            with gzip.open(file, 'wt') as out:
+                out.write('0, 0, 1\n')
+
+            self.assertEqual(kg.load_triples(file).shape, (1, 3))
+
+    def test_fastload(self):
+
+        with tempfile.TemporaryDirectory() as dir:
+            file = os.path.join(dir, 'triples.int.csv.gz')
+            triples = np.random.randint(100_000, size=(5_000, 3))
+
+            with gzip.open(file, 'wt') as out:
+                out.write('\n'.join(f'{s}, {p},{o}' for s, p, o in triples))
+                # -- mixed spacing, no newline after the last line
+
+            for blocksize in [7, 1000, 2**24]:
+                self.assertTrue((kg.fastload(file, blocksize=blocksize) == triples).all())
+
+    def test_nodetable(self):
+
+        pairs = [('http://a', 'iri'), ('Ünïcode', '@nl'), ('', 'none'), ('1', 'none'), ('_:b', 'blank_node')]
+        table = kg.NodeTable.from_pairs(pairs)
+
+        self.assertEqual(len(table), 5)
+        self.assertEqual(list(table), pairs)
+        self.assertEqual(table[1], ('Ünïcode', '@nl'))
+        self.assertEqual(table.labels([3, 0]), ['1', 'http://a'])
+        self.assertEqual(list(table.take([4, 0, 1, 2])), [pairs[4], pairs[0], pairs[1], pairs[2]])
+        self.assertEqual(list(table[1:3]), pairs[1:3])
+
+        with tempfile.TemporaryDirectory() as dir:
+            file = os.path.join(dir, 'nodes.int.csv')
+            with open(file, 'w') as out:
+                out.write('index,annotation,label\n')
+                for i, (label, dt) in reversed(list(enumerate(pairs))):
+                    out.write(f'{i},"{dt}","{label}"\n')
+
+            for _ in range(2): # build and reload the cache
+                i2e, e2i = kg.load_entities(file)
+                self.assertEqual(list(i2e), pairs)
+                self.assertEqual(i2e.annotations, ['iri', 'blank_node', 'none', '@nl'])
+
+    def test_dictionary(self):
+
+        pairs = sorted({(f'http://example.org/{i % 97}/{i}', 'iri' if i % 3 else 'none') for i in range(1000)})
+        e2i = kg.FrontCodedDict.from_pairs(pairs, bucket=8)
+
+        self.assertEqual(len(e2i), len(pairs))
+        for i, pair in enumerate(pairs):
+            self.assertEqual(e2i[pair], i)
+
+        self.assertNotIn(('http://example.org/1/1', '@en'), e2i)
+        self.assertTrue((e2i.lookup(pairs[::-1]) == np.arange(len(pairs))[::-1]).all())
+        self.assertEqual(list(e2i.lookup([('x', 'iri'), pairs[5]])), [-1, 5])
+
+        # unsorted keys
+        shuffled = [pairs[i] for i in np.random.permutation(len(pairs))]
+        e2i = kg.FrontCodedDict.from_pairs(shuffled)
+        self.assertTrue((e2i.lookup(shuffled) == np.arange(len(pairs))).all())
+
+        # pruned
+        o2n = np.full(len(pairs), -1)
+        o2n[::2] = np.arange(len(pairs[::2]))
+        pruned = e2i.remap(o2n)
+        self.assertEqual(len(pruned), len(pairs[::2]))
+        self.assertTrue((pruned.lookup(shuffled[::2]) == np.arange(len(pairs[::2]))).all())
+        self.assertTrue((pruned.lookup(shuffled[1::2]) == -1).all())
+
+    def test_prune(self):
+
+        data = kg.load('micro')
+        data.training = data.training[:1] # node 1 only
+        data.withheld = data.withheld[:0]
+
+        pruned, dist = kg.prune(data, n=1, distances=True)
+        # -- nodes 0, 1, 2 remain
+
+        self.assertEqual(pruned.num_entities, 3)
+        self.assertEqual(list(dist), [1, 0, 1])
+        self.assertEqual(pruned.triples.tolist(), [[0, 0, 1], [1, 0, 2], [0, 0, 2]])
+        self.assertEqual(pruned.e2i[('2', 'none')], 2)
+
+        # compare to a simple set-based implementation on a random graph
+        rng = np.random.default_rng(0)
+        data.num_entities = 1000
+        data.i2e = kg.NodeTable.from_pairs([(str(i), 'none') for i in range(data.num_entities)])
+        data.e2i = kg.FrontCodedDict.from_table(data.i2e)
+        data.triples = rng.integers(1000, size=(1200, 3))
+        data.training = np.asarray([[5, 0], [17, 1]])
+
+        for n in [1, 2, 3]:
+            nodes = {5, 17}
+            for _ in range(n):
+                nodes |= {o for s, _, o in data.triples if s in nodes} | {s for s, _, o in data.triples if o in nodes}
+            nodes = sorted(nodes)
+
+            pruned = kg.prune(data, n=n)
+            self.assertEqual([int(l) for l in pruned.i2e.labels()], nodes)
+            self.assertEqual(pruned.triples.shape[0], sum(1 for s, _, o in data.triples if s in nodes and o in nodes))
+            self.assertEqual(pruned.training[:, 0].tolist(), [nodes.index(5), nodes.index(17)])
+
+    def test_group(self):
+
+        data = kg.load('micro')
+        data.i2e = kg.NodeTable.from_pairs([('0', 'none'), ('1', 'iri'), ('2', '@nl'), ('3', 'iri'), ('4', 'blank_node')])
+        data.e2i = kg.FrontCodedDict.from_table(data.i2e)
+
+        grouped, n2o, o2n = kg.group(data, maps=True)
+
+        self.assertEqual(n2o.tolist(), [1, 3, 4, 0, 2])
+        self.assertEqual(grouped.datatypes(), ['iri', 'blank_node', 'none', '@nl'])
+        self.assertEqual([grouped.i2e[i] for i in range(5)], [data.i2e[o] for o in n2o])
+        self.assertEqual(grouped.e2i[('2', '@nl')], 4)
+
+        self.assertTrue((grouped.triples[:, 0] == o2n[data.triples[:, 0]]).all())
+        self.assertTrue((n2o[grouped.triples[:, 2]] == data.triples[:, 2]).all())
+        self.assertTrue((n2o[grouped.training[:, 0]] == data.training[:, 0]).all())
+
+    def test_group_strings(self):
+
+        string = 'http://www.w3.org/2001/XMLSchema#string'
+
+        data = kg.load('micro')
+        data.i2e = kg.NodeTable.from_pairs([('0', '@nl'), ('1', string), ('2', 'iri'), ('3', '@en'), ('4', string)])
+        data.e2i = kg.FrontCodedDict.from_table(data.i2e)
+
+        grouped = kg.group(data)
+
+        # -- xsd:string still includes the language-tagged literals, but the blocks partition the nodes
+        self.assertEqual(sorted(grouped.datatype_l2g(string).tolist()), [1, 2, 3, 4])
+
+        blocks = grouped.datatype_blocks()
+        self.assertEqual([dt for dt, _, _ in blocks], grouped.datatypes())
+        self.assertEqual(sum([list(range(fr, to)) for _, fr, to in blocks], []), list(range(data.num_entities)))
+
+        for dt, fr, to in blocks:
+            self.assertTrue(all(grouped.i2e[i][1] == dt for i in range(fr, to)))
+
+        with self.assertRaises(AssertionError):
+            data.datatype_blocks()
+
+    def test_reorder(self):
+
+        data = kg.load('micro')
+
+        # -- the labeled nodes 1, 2 and 3 first, then their neighbors 0 (found from 1) and 4 (found from 3)
+        reordered, n2o, o2n = kg.reorder(data, maps=True)
+        self.assertEqual(n2o.tolist(), [1, 2, 3, 0, 4])
+
+        self.assertTrue((reordered.triples[:, 0] == o2n[data.triples[:, 0]]).all())
+        self.assertTrue((n2o[reordered.triples[:, 2]] == data.triples[:, 2]).all())
+        self.assertTrue((n2o[reordered.withheld[:, 0]] == data.withheld[:, 0]).all())
+
+        # -- the datatype blocks of group() are kept
+        data = kg.load('micro')
+        data.i2e = kg.NodeTable.from_pairs([('0', 'iri'), ('1', 'none'), ('2', 'none'), ('3', 'iri'), ('4', 'none')])
+        data.e2i = kg.FrontCodedDict.from_table(data.i2e)
+
+        reordered, n2o, o2n = kg.reorder(data, maps=True)
+        self.assertEqual(n2o.tolist(), [3, 0, 1, 2, 4])
+        self.assertEqual(reordered.datatype_range('iri'), (0, 2))
+        self.assertEqual(reordered.e2i[('0', 'iri')], 1)
+
+    def test_compact(self):
+
+        data = kg.load('micro')
+        data.num_relations = 3
+        data.i2r = ['a', 'b', 'c']
+        data.r2i = {r: i for i, r in enumerate(data.i2r)}
+        data.triples = np.asarray([[0, 0, 1], [0, 1, 1], [1, 0, 2], [2, 1, 3], [4, 1, 3], [4, 1, 0], [0, 2, 1]])
+
+        # -- a and c are merged into the catch-all relation, which makes the last triple a duplicate
+        compacted, o2n = kg.compact(data, k=1, maps=True)
+
+        self.assertEqual(o2n.tolist(), [1, 0, 1])
+        self.assertEqual(compacted.i2r, ['b', 'http://kgbench.info/relation#other'])
+        self.assertEqual(compacted.r2i['http://kgbench.info/relation#other'], 1)
+        self.assertEqual(compacted.num_relations, 2)
+        self.assertEqual(compacted.triples.tolist(), [[0, 1, 1], [0, 0, 1], [1, 1, 2], [2, 0, 3], [4, 0, 3], [4, 0, 0]])
+        self.assertEqual(compacted.training.tolist(), data.training.tolist())
+
+        dropped, o2n = kg.compact(data, min_count=2, merge=False, maps=True)
+
+        self.assertEqual(o2n.tolist(), [0, 1, -1])
+        self.assertEqual(dropped.i2r, ['a', 'b'])
+        self.assertEqual(dropped.triples.tolist(), data.triples[:6].tolist())
+
+        # -- cached arrays of the compacted graph don't collide with those of the original
+        self.assertNotEqual(data._graph_key(), compacted._graph_key())
+        self.assertNotEqual(compacted._graph_key(), dropped._graph_key())
+        self.assertEqual(kg.prune(compacted)._relations.tolist(), [1, 0, 1])
+
+    def test_datatypes(self):
+
+        xsd = 'http://www.w3.org/2001/XMLSchema#'
+        pairs = [('0', 'none'), ('1', 'iri'), ('2', '@nl'), ('3', 'iri'), ('4', xsd + 'string'), ('5', 'blank_node')]
+
+        data = kg.load('micro')
+        data.num_entities = len(pairs)
+        data.i2e = kg.NodeTable.from_pairs(pairs)
+        data.e2i = kg.FrontCodedDict.from_table(data.i2e)
+
+        self.assertEqual(data.datatypes(), ['iri', 'blank_node', 'none', '@nl', xsd + 'string'])
+        self.assertEqual(data.datatype_codes().tolist(), [2, 0, 3, 0, 4, 1])
+
+        self.assertEqual(list(data.datatype_l2g('iri')), [1, 3])
+        self.assertEqual(list(data.datatype_l2g(xsd + 'string')), [2, 4]) # includes language-tagged strings
+        self.assertEqual(list(data.datatype_l2g('@en')), [])
+        self.assertEqual(data.datatype_g2l('iri').tolist(), [-1, 0, -1, 1, -1, -1])
+        self.assertEqual(data.get_strings('iri'), ['1', '3'])
+        self.assertIsNone(data.datatype_range('iri'))
+
+        with self.assertRaises(ValueError):
+            data.datatype_l2g('iri')[0] = 5 # shared arrays are read-only
+
+        grouped = kg.group(data)
+        self.assertEqual(grouped.datatype_range('iri'), (0, 2))
+        self.assertEqual(grouped.datatype_l2g('none'), range(3, 4))
+        self.assertEqual(grouped.datatype_g2l('blank_node').tolist(), [-1, -1, 0, -1, -1, -1])
+        self.assertEqual(grouped.get_strings('iri'), ['1', '3'])
+
+    def test_csr(self):
+
+        rng = np.random.default_rng(0)
+        triples = np.stack([rng.integers(20, size=300), rng.integers(4, size=300), rng.integers(20, size=300)], axis=1)
+
+        out, inc = kg.CSR.from_triples(triples, 21, 4, 'out'), kg.CSR.from_triples(triples, 21, 4, 'in')
+        self.assertEqual(len(out), 21)
+        self.assertEqual(out.degree(20), 0)
+        self.assertTrue((out.degrees() == np.bincount(triples[:, 0], minlength=21)).all())
+
+        for node in range(21):
+            for rel in [None, 0, 3]:
+                match = (triples[:, 0] == node) & (True if rel is None else triples[:, 1] == rel)
+                self.assertEqual(sorted(out.edges_of(node, rel).tolist()), np.flatnonzero(match).tolist())
+                if rel is not None: # -- same relation: in the order of the triples
+                    self.assertEqual(out.neighbors_of(node, rel).tolist(), triples[match, 2].tolist())
+
+                match = (triples[:, 2] == node) & (True if rel is None else triples[:, 1] == rel)
+                self.assertEqual(sorted(inc.neighbors_of(node, rel).tolist()), sorted(triples[match, 0].tolist()))
+
+            self.assertTrue((np.diff(out.relations_of(node)) >= 0).all())
+
+        # -- built lazily on Data, and stored in the cache
+        with tempfile.TemporaryDirectory() as dir:
+            data = kg.load('micro')
+            for file in ['triples.int.csv.gz', 'nodes.int.csv']:
+                open(os.path.join(dir, file), 'w').close()
+            data._dir = dir
+
+            first = data.csr('in')
+            self.assertIs(data.csr('in'), first)
+
+            data._csr = {}
+            second = data.csr('in')
+            self.assertIsInstance(second.neighbors, np.memmap)
+            self.assertTrue((first.neighbors == second.neighbors).all())
+
+            pruned = kg.prune(data, n=1)
+            self.assertEqual(pruned.csr('out').neighbors.shape[0], pruned.triples.shape[0])
+
+    def test_sampler(self):
+        import torch
+        from torch.utils.data import DataLoader
+
+        rng = np.random.default_rng(0)
+        n, r = 50, 3
+
+        data = kg.Data(None)
+        data.num_entities, data.num_relations = n, r
+        data.triples = np.stack([rng.integers(n, size=400), rng.integers(r, size=400), rng.integers(n, size=400)], axis=1)
+        data.training = np.stack([np.arange(10), rng.integers(2, size=10)], axis=1)
+
+        existing = set(map(tuple, data.triples.tolist()))
+        degrees = np.bincount(data.triples[:, 0], minlength=n) + np.bincount(data.triples[:, 2], minlength=n)
+
+        for fanouts in [[4, 2], [-1, 3], [None]]:
+            sample = kg.NeighborSampler(data, fanouts)([3, 1, 7])
+
+            self.assertEqual(sample.targets.tolist(), [3, 1, 7])
+            self.assertEqual(len(sample.blocks), len(fanouts))
+            self.assertEqual(sample.blocks[-1].num_dst, 3)
+
+            for block, fanout in zip(sample.blocks[::-1], fanouts):
+                src, rel, dst = block.edges.t()
+                self.assertLessEqual(src.max().item(), block.num_src - 1)
+                self.assertLessEqual(dst.max().item(), block.num_dst - 1)
+
+                counts = torch.bincount(dst, minlength=block.num_dst)
+                nodes = sample.nodes[:block.num_dst]
+                if fanout in [-1, None]:
+                    self.assertTrue((counts.numpy() == degrees[nodes.numpy()]).all())
+                else:
+                    self.assertLessEqual(counts.max().item(), fanout)
 
+                # -- every sampled edge exists in the graph, with inverse relations for incoming edges
+                for s, p, o in zip(sample.nodes[src].tolist(), rel.tolist(), sample.nodes[dst].tolist()):
+                    self.assertIn((o, p, s) if p < r else (s, p - r, o), existing)
 
+        # -- as the collate function of a multi-process data loader, over (node, class) rows
+        loader = DataLoader(data.training, batch_size=4, shuffle=True, num_workers=2,
+                            collate_fn=kg.NeighborSampler(data, [3, 3]))
+        samples = list(loader)
+        self.assertEqual(sorted(torch.cat([s.targets for s in samples]).tolist()), list(range(10)))
+        for s in samples:
+            self.assertEqual(s.labels.tolist(), data.training[s.targets.numpy(), 1].tolist())
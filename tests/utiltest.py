@@ -21,3 +21,178 @@ class TestUtil(unittest.TestCase):
         for btch in batched:
             btch = np.array(batched[17]).astype(np.float)/255.
 
+
+    def test_images(self):
+        import base64, io, pickle, warnings
+        from PIL import Image
+
+        def b64(img, format='PNG'):
+            out = io.BytesIO()
+            img.save(out, format=format)
+            return base64.urlsafe_b64encode(out.getvalue()).decode('ascii')
+
+        dt = 'http://kgbench.info/dt#base64Image'
+        sizes = [(4, 3), (8, 8), (2, 5)]
+        pairs = [('x', 'iri')] + [(b64(Image.new('RGB', size)), dt) for size in sizes] + [('bm90IGFuIGltYWdl', dt)]
+
+        data = kg.load('micro')
+        data.num_entities = len(pairs)
+        data.i2e = kg.NodeTable.from_pairs(pairs)
+
+        images = data.get_images(cache=100)
+        self.assertEqual(len(images), 4)
+        self.assertEqual([img.size for img in images[:3]], sizes)
+        self.assertEqual(images[1:].batch([1, 0])[0].size, sizes[2])
+
+        self.assertEqual(images.sizes().tolist(), [list(size) for size in sizes] + [[1, 1]])
+
+        self.assertLessEqual(images.cache.used, 100)
+        self.assertIs(images[0], images[0]) # cached
+
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            self.assertEqual(images[3].size, (1, 1))
+            self.assertEqual(len(w), 1)
+
+        images = pickle.loads(pickle.dumps(images))
+        self.assertEqual(images.cache.used, 0)
+        self.assertEqual(images[2].size, sizes[2])
+
+    def test_image_tensor(self):
+        import base64, io, os, tempfile
+        from PIL import Image
+        from torchvision import transforms
+
+        def b64(img):
+            out = io.BytesIO()
+            img.save(out, format='PNG')
+            return base64.urlsafe_b64encode(out.getvalue()).decode('ascii')
+
+        dt = 'http://kgbench.info/dt#base64Image'
+        rng = np.random.default_rng(0)
+        pils = [Image.fromarray(rng.integers(256, size=(h, w, 3), dtype=np.uint8)) for h, w in [(40, 30), (20, 50), (33, 33)]]
+        pairs = [('x', 'iri')] + [(b64(img), dt) for img in pils]
+
+        data = kg.load('micro')
+        data.num_entities = len(pairs)
+        data.i2e = kg.NodeTable.from_pairs(pairs)
+        data.e2i = kg.FrontCodedDict.from_table(data.i2e)
+        data.triples = np.array([[0, 0, 1], [0, 0, 2], [3, 0, 0]])
+        data.training, data.withheld = np.array([[0, 0]]), np.array([[1, 0]])
+
+        expected = transforms.Compose([transforms.Resize(24), transforms.CenterCrop(16), transforms.PILToTensor()])
+        expected = torch.stack([expected(img) for img in pils]).numpy()
+
+        with tempfile.TemporaryDirectory() as dir:
+            with open(os.path.join(dir, 'nodes.int.csv'), 'w') as out:
+                out.write('index,annotation,label\n')
+            data._dir = dir
+
+            first = data.get_image_tensor(size=16, resize=24)
+            self.assertEqual(first.shape, (3, 3, 16, 16))
+            self.assertTrue((first == expected).all())
+
+            second = data.get_image_tensor(size=16, resize=24)
+            self.assertIsInstance(second, np.memmap)
+            self.assertTrue((second == expected).all())
+
+            # -- a permuted copy of the dataset gets the same images, in its own order
+            perm = np.array([0, 3, 1, 2])
+            nw = kg.reindex(data, perm, np.argsort(perm))
+            self.assertTrue((nw.get_image_tensor(size=16, resize=24) == expected[[2, 0, 1]]).all())
+
+            padded = data.get_image_tensor(size=16, crop='pad', workers=2)
+            self.assertTrue((padded[1, :, :4, :] == 0).all()) # wide image, black bars at the top
+
+    def test_image_info(self):
+        import base64, io, os, tempfile, warnings
+        from PIL import Image
+        from kgbench.images import MODES, FORMATS
+
+        def b64(img, format):
+            out = io.BytesIO()
+            img.save(out, format=format)
+            return base64.urlsafe_b64encode(out.getvalue()).decode('ascii')
+
+        dt = 'http://kgbench.info/dt#base64Image'
+        pairs = [('x', 'iri'), (b64(Image.new('RGB', (400, 300)), 'JPEG'), dt), (b64(Image.new('L', (3, 5)), 'PNG'), dt),
+                 ('bm90IGFuIGltYWdl', dt), (b64(Image.new('P', (7, 2)), 'GIF'), dt)]
+
+        data = kg.load('micro')
+        data.num_entities = len(pairs)
+        data.i2e = kg.NodeTable.from_pairs(pairs)
+
+        expected = [[400, 300, MODES.index('RGB'), FORMATS.index('JPEG')], [3, 5, MODES.index('L'), FORMATS.index('PNG')],
+                    [-1, -1, -1, -1], [7, 2, MODES.index('P'), FORMATS.index('GIF')]]
+
+        with tempfile.TemporaryDirectory() as dir:
+            with open(os.path.join(dir, 'nodes.int.csv'), 'w') as out:
+                out.write('index,annotation,label\n')
+            data._dir = dir
+
+            for _ in range(2): # -- built, then loaded from the cache
+                with warnings.catch_warnings(record=True) as w:
+                    warnings.simplefilter('always')
+                    info = data.get_image_info()
+                    self.assertEqual(len(w), 1)
+
+                self.assertEqual(info.tolist(), expected)
+
+            self.assertIsInstance(info, np.memmap)
+
+    def test_size_order(self):
+        from PIL import Image
+
+        rng = np.random.default_rng(0)
+        sizes = rng.integers(1, 30, size=(50, 2))
+        images = [Image.new('RGB', (int(w), int(h)), color=(i, 0, 0)) for i, (w, h) in enumerate(sizes)]
+
+        order = kg.size_order(images, batch_size=4)
+        self.assertEqual(sorted(order.tolist()), list(range(50)))
+        self.assertTrue((order == kg.size_order(sizes, batch_size=4)).all())
+
+        bucketed, total = kg.padding(sizes, batch_size=4, order=order)
+        self.assertLess(bucketed, kg.padding(sizes, batch_size=4)[0])
+        self.assertGreaterEqual(bucketed, total)
+
+        # -- batches follow the order, and the results can be put back in the original order
+        firsts = torch.cat([b[:, 0, :, :].flatten(1).max(dim=1)[0] for b in kg.to_tvbatches(images, batch_size=4, order=order)])
+        result = torch.empty_like(firsts)
+        result[torch.from_numpy(order)] = firsts
+        self.assertTrue(torch.allclose(result * 255, torch.arange(50, dtype=torch.float)))
+
+    def test_tvbatches(self):
+        from PIL import Image
+
+        images = [Image.new('RGB', (i + 1, 2 * i + 1), color=(i, 0, 0)) for i in range(21)]
+
+        expected = list(kg.to_tvbatches(images, batch_size=4, min_size=3))
+        self.assertEqual(len(expected), 6)
+
+        for workers in [1, 3]:
+            batches = list(kg.to_tvbatches(images, batch_size=4, min_size=3, workers=workers, prefetch=1))
+            self.assertEqual(len(batches), len(expected))
+            for batch, exp in zip(batches, expected):
+                self.assertTrue(torch.equal(batch, exp))
+
+        # -- with reuse, each batch is valid until the next is requested
+        for workers in [0, 2]:
+            batches = [b.clone() for b in kg.to_tvbatches(images, batch_size=4, min_size=3, workers=workers, reuse=True)]
+            for batch, exp in zip(batches, expected):
+                self.assertTrue(torch.equal(batch, exp))
+
+        fresh = list(kg.to_tensorbatches(images, batch_size=4, min_size=41))
+        reused = [b.copy() for b in kg.to_tensorbatches(images, batch_size=4, min_size=41, reuse=True)]
+        for batch, exp in zip(reused, fresh):
+            self.assertTrue(np.array_equal(batch, exp))
+
+        # -- integer dtypes keep the pixel values, padding is black
+        batch = kg.to_tensorbatch(images[:2], min_size=5, dtype=np.uint8)
+        self.assertEqual(batch.shape, (2, 3, 5, 5))
+        self.assertEqual(batch[1, 0, 1, 1], 1)
+        self.assertEqual(batch[1, :, 0, :].sum() + batch[1, :, :, 0].sum(), 0)
+
+        # -- closing the generator early should not hang
+        gen = kg.to_tvbatches(images, batch_size=2, workers=2)
+        next(gen)
+        gen.close()